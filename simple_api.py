@@ -1,25 +1,54 @@
 import os
+import sys
 import json
 import asyncio
 import logging
 import uuid
-from datetime import datetime
-from typing import List, Optional
+import socket
+import csv
+import codecs
+import io
+import base64
+import gzip
+import hashlib
+import hmac
+import mimetypes
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import List, Literal, Optional
 
 from dotenv import dotenv_values
 from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
-from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column
-from sqlalchemy import ForeignKey, select, distinct, func, delete, String
-from fastapi import FastAPI, Depends, HTTPException, status
-from fastapi.responses import StreamingResponse
+from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, selectinload
+from sqlalchemy import BigInteger, Column, DateTime, Float, ForeignKey, Index, Integer, MetaData, Table, event, make_url, select, func, delete, update, inspect, text, or_, String
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, Request, status
+from fastapi.responses import FileResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
 
-from bitcoinlib.wallets import Wallet, wallet_create_or_open
+from bitcoinlib.wallets import wallet_create_or_open
 from bitcoinlib.services.services import Service, ServiceError 
 
-from httpx import AsyncClient, ConnectError, HTTPStatusError, TimeoutException
+from httpx import AsyncBaseTransport, AsyncClient, AsyncHTTPTransport, ConnectError, HTTPStatusError, RequestError, TimeoutException
+
+try:
+    import brotli  # необязательная зависимость: без неё отдаём gzip
+except ImportError:
+    brotli = None
+
+try:
+    import redis.asyncio as redis_asyncio  # нужен только при CACHE_REDIS_URL
+    from redis.exceptions import RedisError
+except ImportError:
+    redis_asyncio = None
+    RedisError = OSError
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
@@ -31,15 +60,188 @@ class Config:
     BOT_API: str = f"https://api.telegram.org/bot{BOT_TOKEN}" if BOT_TOKEN else ""
     FILE_API: str = f"https://api.telegram.org/file/bot{BOT_TOKEN}" if BOT_TOKEN else ""
     ADMIN_CHAT_ID: int = int(_config_values.get("ADMIN_CHAT_ID", "0"))
-    DB_URL: str = _config_values.get("DB_URL", "sqlite+aiosqlite:///./sql_app.db")
+    ADMIN_API_TOKEN: str = _config_values.get("ADMIN_API_TOKEN", os.environ.get("ADMIN_API_TOKEN", ""))  # заголовок X-Admin-Token для админских маршрутов
+    DB_URL: str = os.environ.get("DB_URL", _config_values.get("DB_URL", "sqlite+aiosqlite:///./sql_app.db"))
     HTTP_TIMEOUT: int = int(_config_values.get("HTTP_TIMEOUT", "15"))
 
+    # PostgreSQL (postgresql+asyncpg://...): пул соединений
+    DB_POOL_SIZE: int = int(_config_values.get("DB_POOL_SIZE", "10"))
+    DB_MAX_OVERFLOW: int = int(_config_values.get("DB_MAX_OVERFLOW", "20"))
+    DB_POOL_TIMEOUT: int = int(_config_values.get("DB_POOL_TIMEOUT", "30"))
+    DB_POOL_RECYCLE: int = int(_config_values.get("DB_POOL_RECYCLE", "1800"))
+    DB_POOL_PRE_PING: bool = _config_values.get("DB_POOL_PRE_PING", "true").lower() == "true"
+    DB_STATEMENT_TIMEOUT_MS: int = int(_config_values.get("DB_STATEMENT_TIMEOUT_MS", "15000"))
+    # SQLite: сколько ждать блокировку записи, прежде чем вернуть "database is locked"
+    SQLITE_BUSY_TIMEOUT_MS: int = int(_config_values.get("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
     BITCOIN_NETWORK: str = os.environ.get("BITCOIN_NETWORK", _config_values.get("BITCOIN_NETWORK", "testnet")) 
     PAYMENT_TOLERANCE_PERCENT: float = float(_config_values.get("PAYMENT_TOLERANCE_PERCENT", "0.95")) 
 
+    # Пул потоков для блокирующих вызовов bitcoinlib (кошельки, провайдеры блокчейна)
+    BITCOIN_EXECUTOR_WORKERS: int = int(_config_values.get("BITCOIN_EXECUTOR_WORKERS", "4"))
+    BITCOIN_EXECUTOR_MAX_QUEUE: int = int(_config_values.get("BITCOIN_EXECUTOR_MAX_QUEUE", "100"))
+    BITCOIN_CALL_TIMEOUT: float = float(_config_values.get("BITCOIN_CALL_TIMEOUT", "30"))
+
+    # Фоновая проверка оплат
+    PAYMENT_CHECK_INTERVAL: int = int(_config_values.get("PAYMENT_CHECK_INTERVAL", "60"))
+    PAYMENT_SCAN_CONCURRENCY: int = int(_config_values.get("PAYMENT_SCAN_CONCURRENCY", "8"))
+    PAYMENT_PROVIDER_RATE_LIMIT: float = float(_config_values.get("PAYMENT_PROVIDER_RATE_LIMIT", "5"))  # запросов в секунду
+    PAYMENT_PROVIDER_BURST: int = int(_config_values.get("PAYMENT_PROVIDER_BURST", "10"))
+    PAYMENT_SCAN_BATCH_SIZE: int = int(_config_values.get("PAYMENT_SCAN_BATCH_SIZE", "500"))
+    PAYMENT_CHECK_BASE_DELAY: int = int(_config_values.get("PAYMENT_CHECK_BASE_DELAY", "60"))  # секунд после первой проверки
+    PAYMENT_CHECK_MAX_DELAY: int = int(_config_values.get("PAYMENT_CHECK_MAX_DELAY", "3600"))
+    PAYMENT_ORDER_TTL_HOURS: int = int(_config_values.get("PAYMENT_ORDER_TTL_HOURS", "72"))  # после этого заказ -> "expired"
+    PAYMENT_STATUS_CACHE_TTL: float = float(_config_values.get("PAYMENT_STATUS_CACHE_TTL", "20"))  # секунд
+    PAYMENT_EVENTS_KEEPALIVE: float = float(_config_values.get("PAYMENT_EVENTS_KEEPALIVE", "15"))  # секунд между ping в SSE
+
+    # Курс BTC/EUR обновляется в фоне; заказы используют последний удачный курс не старше MAX_STALENESS
+    EXCHANGE_RATE_REFRESH_INTERVAL: int = int(_config_values.get("EXCHANGE_RATE_REFRESH_INTERVAL", "60"))
+    EXCHANGE_RATE_MAX_STALENESS: int = int(_config_values.get("EXCHANGE_RATE_MAX_STALENESS", "300"))
+    EXCHANGE_RATE_PROVIDER_RATE_LIMIT: float = float(_config_values.get("EXCHANGE_RATE_PROVIDER_RATE_LIMIT", "0.5"))  # запросов в секунду
+
+    # Пул заранее сгенерированных адресов оплаты
+    ADDRESS_POOL_WALLET_NAME: str = _config_values.get("ADDRESS_POOL_WALLET_NAME", f"shop_{BITCOIN_NETWORK}_wallet")
+    ADDRESS_POOL_LOW_WATER: int = int(_config_values.get("ADDRESS_POOL_LOW_WATER", "20"))
+    ADDRESS_POOL_TARGET: int = int(_config_values.get("ADDRESS_POOL_TARGET", "100"))
+    ADDRESS_POOL_DERIVE_BATCH: int = int(_config_values.get("ADDRESS_POOL_DERIVE_BATCH", "20"))
+    ADDRESS_POOL_REFILL_INTERVAL: int = int(_config_values.get("ADDRESS_POOL_REFILL_INTERVAL", "30"))
+    AVATAR_CACHE_DIR: str = _config_values.get("AVATAR_CACHE_DIR", "avatar_cache")
+    AVATAR_CACHE_TTL: int = int(_config_values.get("AVATAR_CACHE_TTL", "3600"))  # секунд до повторной проверки аватара в Telegram
+    AVATAR_NEGATIVE_TTL: int = int(_config_values.get("AVATAR_NEGATIVE_TTL", "600"))  # сколько помнить, что аватара нет
+    NOTIFICATION_SEND_CONCURRENCY: int = int(_config_values.get("NOTIFICATION_SEND_CONCURRENCY", "4"))
+    NOTIFICATION_BATCH_SIZE: int = int(_config_values.get("NOTIFICATION_BATCH_SIZE", "50"))
+    NOTIFICATION_RETRY_BASE_DELAY: int = int(_config_values.get("NOTIFICATION_RETRY_BASE_DELAY", "5"))  # секунд до первой повторной отправки
+    NOTIFICATION_RETRY_MAX_DELAY: int = int(_config_values.get("NOTIFICATION_RETRY_MAX_DELAY", "900"))
+    NOTIFICATION_MAX_ATTEMPTS: int = int(_config_values.get("NOTIFICATION_MAX_ATTEMPTS", "10"))
+    NOTIFICATION_POLL_INTERVAL: int = int(_config_values.get("NOTIFICATION_POLL_INTERVAL", "30"))
+    PRODUCT_IMPORT_BATCH_SIZE: int = int(_config_values.get("PRODUCT_IMPORT_BATCH_SIZE", "1000"))
+    PRODUCT_IMPORT_MAX_ERRORS: int = int(_config_values.get("PRODUCT_IMPORT_MAX_ERRORS", "1000"))  # сколько ошибок по строкам возвращать в отчёте
+    # Несколько процессов (uvicorn --workers N, реплики) делят фоновые задачи через БД
+    WORKER_ID: str = _config_values.get("WORKER_ID", f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}")
+    JOB_LEASE_TTL: int = int(_config_values.get("JOB_LEASE_TTL", "120"))  # секунд, после которых лидерство чужого процесса считается потерянным
+    PAYMENT_CLAIM_TTL: int = int(_config_values.get("PAYMENT_CLAIM_TTL", "300"))  # секунд, на которые воркер забирает заказы на проверку
+    NOTIFICATION_CLAIM_TTL: int = int(_config_values.get("NOTIFICATION_CLAIM_TTL", "120"))
+    # Пустой CACHE_REDIS_URL — кэш только в памяти процесса; с Redis кэш и инвалидации общие для всех воркеров
+    CACHE_REDIS_URL: str = _config_values.get("CACHE_REDIS_URL", os.environ.get("CACHE_REDIS_URL", ""))
+    CACHE_NAMESPACE: str = _config_values.get("CACHE_NAMESPACE", "ecommerce")
+    CACHE_MAX_ENTRIES: int = int(_config_values.get("CACHE_MAX_ENTRIES", "10000"))
+    CACHE_MAX_BYTES: int = int(_config_values.get("CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+    CACHE_LOCAL_TTL: float = float(_config_values.get("CACHE_LOCAL_TTL", "5"))  # сколько значение из Redis живёт в памяти процесса
+
 config = Config()
 
-engine = create_async_engine(config.DB_URL)
+# ---- Метрики Prometheus (/metrics) ----
+# При uvicorn --workers N задайте PROMETHEUS_MULTIPROC_DIR, чтобы /metrics собирал значения всех процессов.
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP requests by route and status code.", ["method", "route", "status"])
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time until the response starts, by route.", ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+HTTP_REQUESTS_IN_PROGRESS = Gauge("http_requests_in_progress", "HTTP requests being handled.", multiprocess_mode="livesum")
+DB_QUERIES = Counter("db_queries_total", "SQL statements executed, by statement type.", ["operation"])
+DB_QUERY_ERRORS = Counter("db_query_errors_total", "SQL statements that raised, by statement type.", ["operation"])
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "SQL statement execution time, by statement type.", ["operation"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+UPSTREAM_REQUESTS = Counter("upstream_requests_total", "Outbound HTTP requests, by upstream and outcome.", ["upstream", "outcome"])
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds", "Outbound HTTP time until response headers, by upstream.", ["upstream"],
+    buckets=(0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+BLOCKING_CALLS = Counter("blocking_calls_total", "Calls into blocking libraries (bitcoinlib), by function and outcome.", ["executor", "function", "outcome"])
+BLOCKING_CALL_DURATION = Histogram(
+    "blocking_call_duration_seconds", "Time spent inside blocking library calls, by function.", ["executor", "function"],
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+PAYMENT_SCAN_DURATION = Histogram(
+    "payment_scan_duration_seconds", "Duration of one payment checking cycle.",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+PAYMENT_SCAN_ORDERS = Counter("payment_scan_orders_total", "Orders handled by payment checking cycles, by result.", ["result"])
+NOTIFICATIONS = Counter("notifications_total", "Outbox notification send attempts, by result.", ["result"])
+
+UPSTREAM_NAMES = {
+    "api.telegram.org": "telegram",
+    "api.coingecko.com": "coingecko",
+    "api.kraken.com": "kraken",
+}
+
+def sql_operation(statement: str) -> str:
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") else "OTHER"
+
+def instrument_engine(db_engine):
+    # Стек времён старта в conn.info: выполнения на одном соединении не пересекаются, но ошибка не вызывает after_cursor_execute
+    @event.listens_for(db_engine.sync_engine, "before_cursor_execute")
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started_at", []).append(time.perf_counter())
+
+    @event.listens_for(db_engine.sync_engine, "after_cursor_execute")
+    def observe_query(conn, cursor, statement, parameters, context, executemany):
+        operation = sql_operation(statement)
+        DB_QUERIES.labels(operation).inc()
+        DB_QUERY_DURATION.labels(operation).observe(time.perf_counter() - conn.info["query_started_at"].pop())
+
+    @event.listens_for(db_engine.sync_engine, "handle_error")
+    def observe_query_error(exception_context):
+        operation = sql_operation(exception_context.statement or "")
+        DB_QUERY_ERRORS.labels(operation).inc()
+        if exception_context.connection is not None and exception_context.connection.info.get("query_started_at"):
+            exception_context.connection.info["query_started_at"].pop()
+
+class InstrumentedTransport(AsyncBaseTransport):
+    def __init__(self, transport: AsyncBaseTransport):
+        self.transport = transport
+
+    async def handle_async_request(self, request):
+        upstream = UPSTREAM_NAMES.get(request.url.host, request.url.host)
+        started = time.perf_counter()
+        try:
+            response = await self.transport.handle_async_request(request)
+        except Exception:
+            UPSTREAM_REQUESTS.labels(upstream, "error").inc()
+            raise
+        UPSTREAM_REQUEST_DURATION.labels(upstream).observe(time.perf_counter() - started)
+        UPSTREAM_REQUESTS.labels(upstream, f"{response.status_code // 100}xx").inc()
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+def create_db_engine(db_url: str):
+    backend = make_url(db_url).get_backend_name()
+    if backend == "postgresql":
+        return create_async_engine(
+            db_url,
+            pool_size=config.DB_POOL_SIZE,
+            max_overflow=config.DB_MAX_OVERFLOW,
+            pool_timeout=config.DB_POOL_TIMEOUT,
+            pool_recycle=config.DB_POOL_RECYCLE,
+            pool_pre_ping=config.DB_POOL_PRE_PING,
+            connect_args={"server_settings": {
+                "statement_timeout": str(config.DB_STATEMENT_TIMEOUT_MS),
+                "application_name": "ecommerce-api",
+            }},
+        )
+
+    db_engine = create_async_engine(db_url, connect_args={"timeout": config.SQLITE_BUSY_TIMEOUT_MS / 1000} if backend == "sqlite" else {})
+    if backend == "sqlite":
+        in_memory = make_url(db_url).database in (None, "", ":memory:")
+
+        @event.listens_for(db_engine.sync_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, connection_record):
+            # WAL: читатели не блокируют писателя; synchronous=NORMAL безопасен в режиме WAL
+            cursor = dbapi_connection.cursor()
+            if not in_memory:
+                cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
+            cursor.execute(f"PRAGMA busy_timeout={config.SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.close()
+    return db_engine
+
+engine = create_db_engine(config.DB_URL)
+instrument_engine(engine)
 async_session = async_sessionmaker(engine, expire_on_commit=False)
 
 class Base(DeclarativeBase):
@@ -53,30 +255,107 @@ class Product(Base):
     gender: Mapped[str] = mapped_column(index=True)
     category: Mapped[str] = mapped_column(index=True)
     image_url: Mapped[str]
+    # Архивный товар скрыт из каталога и корзин, но строка остаётся для истории
+    archived_at: Mapped[Optional[datetime]] = mapped_column(nullable=True, index=True)
 
 class CartItem(Base):
     __tablename__ = "cart"
     id: Mapped[int] = mapped_column(primary_key=True)
-    user_id: Mapped[int] = mapped_column(index=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
     product_id: Mapped[int] = mapped_column(ForeignKey("products.id"), index=True)
     quantity: Mapped[int] = mapped_column(default=1)
 
+    __table_args__ = (
+        Index("uq_cart_user_id_product_id", "user_id", "product_id", unique=True),
+    )
+
 class Order(Base):
     __tablename__ = "orders"
     id: Mapped[str] = mapped_column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
-    user_id: Mapped[int] = mapped_column(index=True)
+    user_id: Mapped[int] = mapped_column(BigInteger, index=True)
     name: Mapped[Optional[str]] = mapped_column(nullable=True)
     telegram_username: Mapped[Optional[str]] = mapped_column(nullable=True) 
     address: Mapped[Optional[str]] = mapped_column(nullable=True)
     postcode: Mapped[Optional[str]] = mapped_column(nullable=True)
     city: Mapped[Optional[str]] = mapped_column(nullable=True)
     country: Mapped[Optional[str]] = mapped_column(nullable=True)
-    items: Mapped[str]
+    # Устаревшая JSON-колонка: позиции заказа теперь в order_items, здесь только для старых строк и бэкфилла
+    items_json: Mapped[str] = mapped_column("items", default="[]", server_default="[]")
     total: Mapped[int] 
     status: Mapped[str] = mapped_column(default="unpaid", index=True)
     payment_address: Mapped[Optional[str]] = mapped_column(nullable=True, index=True) 
     payment_amount: Mapped[Optional[float]] = mapped_column(nullable=True) 
-    created_at: Mapped[datetime] = mapped_column(default=func.now())
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    next_check_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+    check_attempts: Mapped[int] = mapped_column(default=0, server_default="0")
+    btc_rate_eur: Mapped[Optional[float]] = mapped_column(nullable=True)
+    btc_rate_source: Mapped[Optional[str]] = mapped_column(nullable=True)
+    btc_rate_fetched_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+    order_items: Mapped[List["OrderItem"]] = relationship(back_populates="order", cascade="all, delete-orphan", lazy="raise", order_by="OrderItem.id")
+
+    __table_args__ = (
+        Index("ix_orders_status_next_check_at", "status", "next_check_at"),
+        # Keyset-пагинация истории заказов по (created_at, id), с фильтром и без
+        Index("ix_orders_created_at_id", "created_at", "id"),
+        Index("ix_orders_user_id_created_at_id", "user_id", "created_at", "id"),
+        Index("ix_orders_status_created_at_id", "status", "created_at", "id"),
+    )
+
+class OrderItem(Base):
+    __tablename__ = "order_items"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    order_id: Mapped[str] = mapped_column(ForeignKey("orders.id", ondelete="CASCADE"), index=True)
+    product_id: Mapped[int] = mapped_column(index=True)  # без FK: история заказов переживает удаление товара
+    name: Mapped[str]
+    price: Mapped[int]
+    gender: Mapped[str]
+    category: Mapped[str]
+    image_url: Mapped[str]
+    quantity: Mapped[int]
+
+    order: Mapped["Order"] = relationship(back_populates="order_items")
+
+class PaymentAddress(Base):
+    __tablename__ = "payment_addresses"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    address: Mapped[str] = mapped_column(unique=True)
+    network: Mapped[str]
+    wallet_name: Mapped[str]
+    status: Mapped[str] = mapped_column(default="available")
+    order_id: Mapped[Optional[str]] = mapped_column(nullable=True, index=True)
+    user_id: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+    __table_args__ = (
+        Index("ix_payment_addresses_network_status_id", "network", "status", "id"),
+    )
+
+# Аренда singleton-задачи: одна строка на задачу, владелец продлевает expires_at, пока жив.
+class JobLease(Base):
+    __tablename__ = "job_leases"
+    name: Mapped[str] = mapped_column(String, primary_key=True)
+    owner: Mapped[str]
+    expires_at: Mapped[datetime]
+
+# Исходящие уведомления: пишутся в той же транзакции, что и изменение заказа, отправляются фоновым воркером.
+class OutboxMessage(Base):
+    __tablename__ = "notification_outbox"
+    id: Mapped[int] = mapped_column(primary_key=True)
+    chat_id: Mapped[int] = mapped_column(BigInteger)
+    text: Mapped[str]
+    parse_mode: Mapped[str] = mapped_column(default="HTML")
+    status: Mapped[str] = mapped_column(default="pending")
+    attempts: Mapped[int] = mapped_column(default=0)
+    next_attempt_at: Mapped[datetime]
+    last_error: Mapped[Optional[str]] = mapped_column(nullable=True)
+    created_at: Mapped[datetime] = mapped_column(default=datetime.utcnow)
+    sent_at: Mapped[Optional[datetime]] = mapped_column(nullable=True)
+
+    __table_args__ = (
+        Index("ix_notification_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
 
 class ProductIn(BaseModel):
     name: str = Field(min_length=1)
@@ -103,6 +382,14 @@ class CartProductOut(BaseModel):
     class Config:
         from_attributes = True
 
+class CartOperationIn(BaseModel):
+    op: Literal["set", "increment", "remove"]
+    product_id: int = Field(gt=0)
+    quantity: int = 1  # для "set" — новое количество (0 удаляет), для "increment" — изменение (может быть отрицательным)
+
+class CartBatchIn(BaseModel):
+    operations: List[CartOperationIn] = Field(min_length=1, max_length=100)
+
 class OrderIn(BaseModel):
     user_id: int = Field(gt=0)
     items: List[CartProductOut] = Field(min_items=1)
@@ -128,25 +415,28 @@ class OrderOut(BaseModel):
     status: str
     payment_address: Optional[str] = None
     payment_amount: Optional[float] = None
+    btc_rate_eur: Optional[float] = None
+    btc_rate_source: Optional[str] = None
+    btc_rate_fetched_at: Optional[datetime] = None
     created_at: datetime
 
     class Config:
         from_attributes = True
 
     @classmethod
-    def from_orm_with_items_parsed(cls, obj: Order):
-        items_parsed: List[CartProductOut] = []
-        if obj.items:
-            try:
-                parsed_json = json.loads(obj.items)
-                if isinstance(parsed_json, list):
-                    items_parsed = [CartProductOut(**item_dict) for item_dict in parsed_json]
-                else:
-                    logger.warning(f"Order '{obj.id}' items field is not a JSON list: {obj.items}")
-            except json.JSONDecodeError as e:
-                logger.error(f"JSONDecodeError parsing items for order {obj.id}: {e}")
-            except Exception as e:
-                logger.error(f"Unknown error parsing items for order {obj.id}: {e}")
+    def from_orm_with_items(cls, obj: Order):
+        items = [
+            CartProductOut(
+                id=item.product_id,
+                name=item.name,
+                price=item.price,
+                gender=item.gender,
+                category=item.category,
+                image_url=item.image_url,
+                quantity=item.quantity
+            )
+            for item in obj.order_items
+        ]
 
         return cls(
             id=obj.id,
@@ -157,14 +447,38 @@ class OrderOut(BaseModel):
             postcode=obj.postcode,
             city=obj.city,
             country=obj.country,
-            items=items_parsed,
+            items=items,
             total=obj.total,
             status=obj.status,
             payment_address=obj.payment_address,
             payment_amount=obj.payment_amount,
+            btc_rate_eur=obj.btc_rate_eur,
+            btc_rate_source=obj.btc_rate_source,
+            btc_rate_fetched_at=obj.btc_rate_fetched_at,
             created_at=obj.created_at
         )
 
+class OrderPageOut(BaseModel):
+    items: List[OrderOut]
+    next_cursor: Optional[str] = None
+
+class ExchangeRateQuote(BaseModel):
+    rate: float
+    source: str
+    fetched_at: datetime
+
+class ProductImportError(BaseModel):
+    line: int
+    error: str
+
+class ProductImportReport(BaseModel):
+    rows: int = 0
+    created: int = 0
+    updated: int = 0
+    failed: int = 0
+    errors: List[ProductImportError] = []
+    errors_truncated: bool = False
+
 class UpdateOrderDeliveryIn(BaseModel):
     order_id: str
     name: str = Field(min_length=1)
@@ -174,17 +488,18 @@ class UpdateOrderDeliveryIn(BaseModel):
     city: str = Field(min_length=1)
     country: str = Field(min_length=1)
 
+class TelegramDeliveryError(Exception):
+    def __init__(self, message: str, retry_after: Optional[float] = None, permanent: bool = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.permanent = permanent
+
 class TelegramService:
-    def __init__(self, bot_api: str, admin_chat_id: int, http_client: AsyncClient):
+    def __init__(self, bot_api: str, http_client: AsyncClient):
         self.bot_api = bot_api
-        self.admin_chat_id = admin_chat_id
         self.http_client = http_client
 
-    async def send_message(self, chat_id: int, text: str, parse_mode: str = "HTML"):
-        if not self.admin_chat_id:
-            logger.warning("ADMIN_CHAT_ID is not set. Message will not be sent.")
-            return
-
+    async def deliver_message(self, chat_id: int, text: str, parse_mode: str = "HTML"):
         payload = {
             "chat_id": chat_id,
             "text": text,
@@ -192,12 +507,24 @@ class TelegramService:
         }
         try:
             response = await self.http_client.post(f"{self.bot_api}/sendMessage", json=payload, timeout=config.HTTP_TIMEOUT)
-            response.raise_for_status()
-            logger.info(f"Message successfully sent to chat {chat_id}.")
-        except (ConnectError, TimeoutException, HTTPStatusError) as e:
-            logger.error(f"Failed to send message to Telegram (chat: {chat_id}) due to network/HTTP error: {e}")
-        except Exception as e:
-            logger.error(f"Failed to send message to Telegram (chat: {chat_id}): {e}")
+        except RequestError as e:
+            # Любая транспортная ошибка (соединение, таймаут, обрыв чтения, протокол) — временная, повторяем
+            raise TelegramDeliveryError(f"network error: {e!r}")
+
+        if response.status_code == 429:
+            try:
+                retry_after = float(response.json().get("parameters", {}).get("retry_after", 0)) or None
+            except Exception:
+                retry_after = None
+            raise TelegramDeliveryError("rate limited by Telegram (HTTP 429)", retry_after=retry_after)
+        if response.is_error:
+            try:
+                description = response.json().get("description", "")
+            except Exception:
+                description = response.text[:200]
+            # 4xx (кроме 429) — неверный запрос или бот заблокирован: повтор не поможет
+            raise TelegramDeliveryError(f"HTTP {response.status_code}: {description}", permanent=response.status_code < 500)
+        logger.info(f"Message successfully sent to chat {chat_id}.")
 
     async def get_user_profile_photos(self, user_id: int) -> Optional[str]:
         try:
@@ -213,11 +540,12 @@ class TelegramService:
                 return None
             return data["result"]["photos"][0][0]["file_id"]
         except (ConnectError, TimeoutException, HTTPStatusError) as e:
+            # Ошибку не выдаём за "аватара нет": иначе она попадёт в негативный кэш
             logger.error(f"Failed to get profile photo for user {user_id} due to network/HTTP error: {e}")
-            return None
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Failed to get avatar: {e}")
         except Exception as e:
             logger.error(f"Failed to get profile photo for user {user_id}: {e}")
-            return None
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Failed to get avatar: {e}")
 
     async def get_file_path(self, file_id: str) -> Optional[str]:
         try:
@@ -239,94 +567,575 @@ class TelegramService:
             logger.error(f"Failed to get file_path for file_id {file_id}: {e}")
             return None
 
-    async def download_file(self, file_path: str):
+    async def open_file_stream(self, file_path: str):
+        # Тело не читается целиком: вызывающий код обязан закрыть ответ (aclose)
+        request = self.http_client.build_request("GET", f"{config.FILE_API}/{file_path}", timeout=config.HTTP_TIMEOUT)
         try:
-            response = await self.http_client.get(f"{config.FILE_API}/{file_path}", timeout=config.HTTP_TIMEOUT)
-            response.raise_for_status()
-            return StreamingResponse(response.aiter_bytes(), media_type="image/jpeg")
-        except (ConnectError, TimeoutException, HTTPStatusError) as e:
-            logger.error(f"Failed to download file from path {file_path} due to network/HTTP error: {e}")
+            response = await self.http_client.send(request, stream=True)
+        except RequestError as e:
+            logger.error(f"Failed to download file from path {file_path} due to network error: {e}")
             raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Failed to download avatar: {e}")
-        except Exception as e:
-            logger.error(f"Failed to download file from path {file_path}: {e}")
+        if response.is_error:
+            await response.aclose()
+            logger.error(f"Failed to download file from path {file_path}: upstream returned HTTP {response.status_code}")
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Failed to download avatar: HTTP {response.status_code}")
+        return response
+
+    def file_content_type(self, file_path: str, response) -> str:
+        # Файловый сервер Telegram часто отдаёт application/octet-stream, поэтому тип берём по расширению
+        return mimetypes.guess_type(file_path)[0] or response.headers.get("content-type", "application/octet-stream")
+
+class LRUCache:
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries: OrderedDict = OrderedDict()
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[bytes]:
+        entry = self._entries.get(key)
+        if entry is None or (entry[0] is not None and entry[0] <= time.monotonic()):
+            if entry is not None:
+                self._drop(key)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: str, value: bytes, ttl: Optional[float] = None):
+        self._drop(key)
+        if len(value) > self.max_bytes:
+            return
+        self._entries[key] = (time.monotonic() + ttl if ttl else None, value)
+        self._size += len(value)
+        # Вытесняем давно не читанные записи, пока не уложимся в лимиты по числу и по байтам
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            self._drop(next(iter(self._entries)))
+            self.evictions += 1
+
+    def delete(self, keys):
+        for key in keys:
+            self._drop(key)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+# Кэш, общий для всего приложения: всегда локальный LRU, а при заданном Redis — ещё и общее хранилище для всех воркеров.
+# Инвалидации уходят в pub/sub, чтобы остальные процессы сбросили свои локальные копии и in-memory снимки.
+class SharedCache:
+    def __init__(self, local: LRUCache, redis_url: str, namespace: str, local_ttl: float, worker_id: str):
+        self.local = local
+        self.namespace = namespace
+        self.channel = f"{namespace}:invalidate"
+        self.events_channel = f"{namespace}:events"
+        self.local_ttl = local_ttl
+        self.worker_id = worker_id
+        self.redis = None
+        if redis_url:
+            if redis_asyncio is None:
+                raise RuntimeError("CACHE_REDIS_URL is set, but the 'redis' package is not installed.")
+            self.redis = redis_asyncio.from_url(redis_url)
+        self._listeners: list = []
+        self._event_handlers: dict = {}
+        self.errors = 0
+        self.invalidations_received = 0
+
+    @property
+    def backend(self) -> str:
+        return "redis" if self.redis is not None else "local"
+
+    def _key(self, key: str) -> str:
+        return f"{self.namespace}:{key}"
+
+    def _on_error(self, operation: str, error: Exception):
+        # Недоступный Redis не должен ронять запросы: работаем как при промахе кэша
+        self.errors += 1
+        logger.warning(f"CACHE: Redis {operation} failed: {error}")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        value = self.local.get(key)
+        if value is not None or self.redis is None:
+            return value
+        try:
+            value = await self.redis.get(self._key(key))
+        except (RedisError, OSError) as e:
+            self._on_error("GET", e)
+            return None
+        if value is not None:
+            self.local.set(key, value, self.local_ttl)
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        if self.redis is None:
+            self.local.set(key, value, ttl)
+            return
+        self.local.set(key, value, min(ttl, self.local_ttl))
+        try:
+            await self.redis.set(self._key(key), value, px=max(int(ttl * 1000), 1))
+        except (RedisError, OSError) as e:
+            self._on_error("SET", e)
+
+    async def get_json(self, key: str):
+        value = await self.get(key)
+        return json.loads(value) if value is not None else None
+
+    async def set_json(self, key: str, value, ttl: float):
+        await self.set(key, json.dumps(value, default=str).encode(), ttl)
+
+    async def invalidate(self, *keys: str):
+        # Вызывающий процесс своё состояние уже обновил; слушатели срабатывают только у остальных воркеров
+        self.local.delete(keys)
+        if self.redis is None:
+            return
+        try:
+            await self.redis.delete(*[self._key(key) for key in keys])
+            await self.redis.publish(self.channel, json.dumps({"origin": self.worker_id, "keys": list(keys)}))
+        except (RedisError, OSError) as e:
+            self._on_error("INVALIDATE", e)
+
+    def on_invalidate(self, prefix: str, callback):
+        self._listeners.append((prefix, callback))
+
+    def _notify(self, keys: Optional[list] = None):
+        for prefix, callback in self._listeners:
+            if keys is None or any(key.startswith(prefix) for key in keys):
+                try:
+                    callback()
+                except Exception as e:
+                    logger.error(f"CACHE: Invalidation callback for '{prefix}' failed: {e}", exc_info=True)
+
+    def on_event(self, topic: str, handler):
+        self._event_handlers.setdefault(topic, []).append(handler)
+
+    async def publish_event(self, topic: str, payload: dict):
+        # Свой процесс событие уже обработал сам; через Redis оно уходит остальным воркерам
+        if self.redis is None:
+            return
+        try:
+            await self.redis.publish(self.events_channel, json.dumps({"origin": self.worker_id, "topic": topic, "payload": payload}))
+        except (RedisError, OSError) as e:
+            self._on_error("PUBLISH", e)
+
+    def _dispatch_event(self, message: dict):
+        for handler in self._event_handlers.get(message.get("topic"), ()):
+            try:
+                handler(message["payload"])
+            except Exception as e:
+                logger.error(f"CACHE: Event handler for '{message.get('topic')}' failed: {e}", exc_info=True)
+
+    async def listen(self):
+        if self.redis is None:
+            return
+        while True:
+            try:
+                pubsub = self.redis.pubsub()
+                try:
+                    await pubsub.subscribe(self.channel, self.events_channel)
+                    logger.info(f"CACHE: Subscribed to '{self.channel}' and '{self.events_channel}'.")
+                    async for message in pubsub.listen():
+                        if message["type"] != "message":
+                            continue
+                        payload = json.loads(message["data"])
+                        if payload.get("origin") == self.worker_id:
+                            continue
+                        channel = message["channel"].decode() if isinstance(message["channel"], bytes) else message["channel"]
+                        if channel == self.events_channel:
+                            self._dispatch_event(payload)
+                            continue
+                        self.invalidations_received += 1
+                        self.local.delete(payload["keys"])
+                        self._notify(payload["keys"])
+                finally:
+                    await pubsub.aclose()
+            except asyncio.CancelledError:
+                logger.info("listen (cache invalidations) task cancelled.")
+                break
+            except Exception as e:
+                self._on_error("SUBSCRIBE", e)
+                # Пока подписки не было, сообщения могли потеряться: сбрасываем всё локальное
+                self.local.clear()
+                self._notify()
+                await asyncio.sleep(1)
+
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+
+    def stats(self) -> dict:
+        return {
+            "backend": self.backend,
+            "local": self.local.stats(),
+            "errors": self.errors,
+            "invalidations_received": self.invalidations_received,
+        }
+
+# Аватары хранятся на диске по sha256 содержимого, а в памяти только user_id -> файл и срок годности.
+# Отсутствие аватара тоже кэшируется (digest=None), чтобы не спрашивать Telegram на каждой странице.
+class AvatarCache:
+    def __init__(self, telegram_service: TelegramService, cache: SharedCache, cache_dir: str, ttl: float, negative_ttl: float):
+        self.telegram_service = telegram_service
+        self.cache = cache
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._in_flight: dict = {}
+        self._last_prune = time.monotonic()
+        self._prune_tasks: set = set()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    async def get(self, user_id: int) -> Optional[dict]:
+        # Файл может лежать на диске другой машины: тогда скачиваем его заново
+        entry = await self.cache.get_json(f"avatar:{user_id}")
+        if entry is not None and (entry["digest"] is None or os.path.exists(self.path_for(entry["digest"]))):
+            self.hits += 1
+            return entry if entry["digest"] else None
+
+        task = self._in_flight.get(user_id)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(self._fetch(user_id))
+            self._in_flight[user_id] = task
+            task.add_done_callback(lambda done, user_id=user_id: self._in_flight.pop(user_id, None))
+        entry = await asyncio.shield(task)
+        return entry if entry["digest"] else None
+
+    async def _fetch(self, user_id: int) -> dict:
+        file_id = await self.telegram_service.get_user_profile_photos(user_id)
+        if not file_id:
+            entry = {"digest": None}
+            await self.cache.set_json(f"avatar:{user_id}", entry, self.negative_ttl)
+            return entry
+
+        file_path = await self.telegram_service.get_file_path(file_id)
+        if not file_path:
+            raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail="Failed to get avatar file path")
+
+        upstream = await self.telegram_service.open_file_stream(file_path)
+        content_type = self.telegram_service.file_content_type(file_path, upstream)
+        digest, size = await self._store(upstream)
+        if time.monotonic() - self._last_prune > self.ttl:
+            self._last_prune = time.monotonic()
+            # Держим ссылку до завершения: иначе задачу может собрать GC, а её исключение потеряется
+            prune_task = asyncio.create_task(asyncio.to_thread(self._prune_files))
+            self._prune_tasks.add(prune_task)
+            prune_task.add_done_callback(self._on_prune_done)
+        entry = {"digest": digest, "content_type": content_type, "size": size}
+        await self.cache.set_json(f"avatar:{user_id}", entry, self.ttl)
+        return entry
+
+    async def _store(self, upstream) -> tuple:
+        # Пишем поток во временный файл, считая sha256 на лету, — аватар целиком в памяти не держим
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = os.path.join(self.cache_dir, f"{uuid.uuid4().hex}.tmp")
+        content_hash = hashlib.sha256()
+        size = 0
+        try:
+            with open(tmp_path, "wb") as f:
+                async for chunk in upstream.aiter_bytes():
+                    content_hash.update(chunk)
+                    size += len(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            digest = content_hash.hexdigest()
+            await asyncio.to_thread(self._commit_file, tmp_path, digest)
+        except RequestError as e:
+            # Включая обрыв посреди тела (ReadError, RemoteProtocolError) — это сбой upstream, а не наш
+            logger.error(f"Failed to download avatar file: {e}")
             raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY, detail=f"Failed to download avatar: {e}")
+        finally:
+            await upstream.aclose()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return digest, size
+
+    def _commit_file(self, tmp_path: str, digest: str):
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.utime(path)  # тот же аватар: только продлеваем жизнь файла
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Переименование атомарно: параллельный читатель не увидит половину файла
+        os.replace(tmp_path, path)
+
+    def _on_prune_done(self, task: asyncio.Task):
+        self._prune_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"AVATAR CACHE: Pruning stale avatar files failed: {task.exception()}")
+
+    def _prune_files(self):
+        # Запись в кэше живёт не дольше ttl, а повторная загрузка обновляет mtime файла:
+        # всё, что не трогали дольше 2*ttl, уже ни на что не ссылается
+        cutoff = time.time() - 2 * self.ttl
+        removed = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    continue
+        if removed:
+            logger.info(f"AVATAR CACHE: Pruned {removed} stale avatar files.")
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
+
+
+# Отдельный ограниченный пул потоков: синхронные вызовы bitcoinlib не должны блокировать event loop.
+class BlockingExecutor:
+    def __init__(self, name: str, max_workers: int, max_queue: int, call_timeout: float):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.call_timeout = call_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.active = 0
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.rejected = 0
+        self.finished_calls = 0
+        self.total_call_seconds = 0.0
+
+    def _invoke(self, func, args, kwargs):
+        with self._lock:
+            self.queued -= 1
+            self.active += 1
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            duration = time.perf_counter() - started
+            BLOCKING_CALL_DURATION.labels(self.name, getattr(func, "__name__", "unknown")).observe(duration)
+            with self._lock:
+                self.active -= 1
+                self.finished_calls += 1
+                self.total_call_seconds += duration
+
+    def _on_pool_future_done(self, pool_future):
+        # Таймаут или shutdown отменили вызов, пока он ждал в очереди: _invoke не запустится и очередь не уменьшит
+        if pool_future.cancelled():
+            with self._lock:
+                self.queued -= 1
+
+    async def run(self, func, *args, timeout: Optional[float] = None, **kwargs):
+        function_name = getattr(func, "__name__", "unknown")
+        with self._lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                BLOCKING_CALLS.labels(self.name, function_name, "rejected").inc()
+                raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"{self.name} executor queue is full.")
+            self.queued += 1
+
+        try:
+            pool_future = self._executor.submit(self._invoke, func, args, kwargs)
+        except Exception:
+            with self._lock:
+                self.queued -= 1
+            raise
+        pool_future.add_done_callback(self._on_pool_future_done)
+        try:
+            result = await asyncio.wait_for(asyncio.wrap_future(pool_future), timeout=timeout or self.call_timeout)
+        except asyncio.TimeoutError:
+            # Поток нельзя прервать: он доработает в фоне, но вызывающий больше не ждёт.
+            with self._lock:
+                self.timed_out += 1
+            BLOCKING_CALLS.labels(self.name, function_name, "timeout").inc()
+            logger.error(f"{self.name} call {function_name} timed out after {timeout or self.call_timeout}s.")
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT, detail=f"{self.name} call timed out.")
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            BLOCKING_CALLS.labels(self.name, function_name, "error").inc()
+            raise
+        with self._lock:
+            self.completed += 1
+        BLOCKING_CALLS.labels(self.name, function_name, "ok").inc()
+        return result
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "name": self.name,
+                "max_workers": self.max_workers,
+                "max_queue": self.max_queue,
+                "call_timeout": self.call_timeout,
+                "queue_depth": self.queued,
+                "active": self.active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "timed_out": self.timed_out,
+                "rejected": self.rejected,
+                "avg_call_seconds": self.total_call_seconds / self.finished_calls if self.finished_calls else 0.0,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+# Token bucket: не больше `rate` запросов в секунду к одному провайдеру, с запасом `burst`.
+class AsyncRateLimiter:
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated_at) * self.rate)
+                self._updated_at = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+# TTL-кэш с объединением одновременных запросов (single-flight): на один ключ — не больше одного fetch за TTL.
+class SingleFlightCache:
+    def __init__(self, ttl: float, max_entries: int = 10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries: dict = {}
+        self._in_flight: dict = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_or_fetch(self, key, fetch):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self.hits += 1
+            return entry[1]
+
+        task = self._in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = asyncio.ensure_future(fetch())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done, key=key: self._on_fetched(key, done))
+        # shield: отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(task)
+
+    def _on_fetched(self, key, task: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None:
+            return  # ошибки не кэшируем
+        if len(self._entries) >= self.max_entries:
+            self._evict_expired()
+        self._entries[key] = (time.monotonic() + self.ttl, task.result())
+
+    def _evict_expired(self):
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._entries.items() if expires_at <= now]:
+            del self._entries[key]
+        if len(self._entries) >= self.max_entries:
+            self._entries.clear()
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "in_flight": len(self._in_flight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
 
 class BitcoinPaymentService:
-    def __init__(self, network: str):
+    def __init__(self, network: str, executor: BlockingExecutor, rate_limiter: AsyncRateLimiter, status_cache: SingleFlightCache, shared_cache: SharedCache):
         self.network = network
-        self.service = Service(network=self.network) 
+        self.executor = executor
+        self.rate_limiter = rate_limiter
+        self.status_cache = status_cache
+        self.shared_cache = shared_cache
+        self.service = Service(network=self.network)
 
-    async def get_user_wallet(self, user_id: int) -> Wallet:
-        wallet_name = f"user_{user_id}_{self.network}_wallet" 
-        try:
-            wallet = wallet_create_or_open(wallet_name, network=self.network)
-            logger.info(f"Wallet '{wallet_name}' created or opened successfully on network '{self.network}'.")
-            
-            if hasattr(wallet, 'mnemonic') and wallet.mnemonic:
-                logger.debug(f"Wallet '{wallet_name}' mnemonic: {wallet.mnemonic}")
-            else:
-                logger.info(f"Wallet '{wallet_name}' does not have a mnemonic or it's not exposed this way.")
-
-            return wallet
-        except Exception as create_e:
-            logger.error(f"Failed to create or open wallet '{wallet_name}' for network '{self.network}': {create_e}")
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f"Failed to create Bitcoin wallet: {create_e}")
-
-    async def generate_new_payment_address(self, user_id: int) -> str:
-        user_wallet = await self.get_user_wallet(user_id)
-        new_key = user_wallet.get_key()
-        logger.info(f"Generated new payment address from wallet '{user_wallet.name}' for network '{self.network}': {new_key.address}")
-        
+    def _warn_if_unexpected_address(self, address: str):
         if self.network == 'testnet':
-            if not (new_key.address.startswith('tb1') or new_key.address.startswith('m') or new_key.address.startswith('n') or new_key.address.startswith('2')):
-                 logger.warning(f"Generated address '{new_key.address}' for testnet doesn't look like a standard Bitcoin Testnet address (expected tb1, m, n, or 2).")
+            if not (address.startswith('tb1') or address.startswith('m') or address.startswith('n') or address.startswith('2')):
+                 logger.warning(f"Generated address '{address}' for testnet doesn't look like a standard Bitcoin Testnet address (expected tb1, m, n, or 2).")
         elif self.network == 'mainnet':
-            if not (new_key.address.startswith('bc1') or new_key.address.startswith('1') or new_key.address.startswith('3')):
-                 logger.warning(f"Generated address '{new_key.address}' for mainnet doesn't look like a standard Bitcoin Mainnet address (expected bc1, 1, or 3).")
-        return new_key.address
+            if not (address.startswith('bc1') or address.startswith('1') or address.startswith('3')):
+                 logger.warning(f"Generated address '{address}' for mainnet doesn't look like a standard Bitcoin Mainnet address (expected bc1, 1, or 3).")
 
-    async def get_btc_exchange_rate(self) -> float:
-        try:
-            async with AsyncClient() as client:
-                response = await client.get("https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=eur", timeout=config.HTTP_TIMEOUT)
-                response.raise_for_status()
-                data = response.json()
-                rate = data["bitcoin"]["eur"]
-                logger.info(f"Received BTC/EUR rate from CoinGecko: {rate}")
-                return rate
-        except (ConnectError, TimeoutException, HTTPStatusError) as e:
-            logger.warning(f"CoinGecko API failed ({e}). Trying backup exchange rate API.")
-        except Exception as e:
-            logger.warning(f"CoinGecko API failed with unexpected error ({e}). Trying backup exchange rate API.")
-        
-        try:
-            async with AsyncClient() as client:
-                response = await client.get("https://api.kraken.com/0/public/Ticker?pair=XBTEUR", timeout=config.HTTP_TIMEOUT)
-                response.raise_for_status()
-                data = response.json()
-                if data and 'result' in data and 'XXBTZEUR' in data['result'] and 'c' in data['result']['XXBTZEUR']:
-                    rate = float(data['result']['XXBTZEUR']['c'][0])
-                    logger.info(f"Received BTC/EUR rate from Kraken: {rate}")
-                    return rate
-                else:
-                    raise ValueError("Kraken API response invalid or missing expected data.")
-        except (ConnectError, TimeoutException, HTTPStatusError, ValueError) as e:
-            logger.error(f"Both CoinGecko and Kraken APIs failed to retrieve BTC/EUR rate: {e}")
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to retrieve BTC exchange rate from any source.")
-        except Exception as e:
-            logger.error(f"Unexpected error retrieving BTC/EUR rate from Kraken: {e}")
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to retrieve BTC exchange rate due to unexpected error.")
+    def _derive_addresses_sync(self, wallet_name: str, count: int) -> List[str]:
+        wallet = wallet_create_or_open(wallet_name, network=self.network)
+        # new_key(), а не get_key(): get_key() отдаёт один и тот же неиспользованный ключ
+        return [wallet.new_key().address for _ in range(count)]
+
+    async def derive_addresses(self, wallet_name: str, count: int) -> List[str]:
+        addresses = await self.executor.run(self._derive_addresses_sync, wallet_name, count)
+        for address in addresses:
+            self._warn_if_unexpected_address(address)
+        return addresses
+
+    async def _fetch_received_satoshi(self, payment_address: str) -> int:
+        await self.rate_limiter.acquire()
+        transactions = await self.executor.run(self.service.gettransactions, payment_address)
 
-    async def check_address_transactions(self, payment_address: str, required_amount_btc: float, tolerance_percent: float) -> bool:
         total_received_satoshi = 0
-        try:
-            transactions = self.service.gettransactions(payment_address) 
+        for tx in transactions:
+            for tx_out in tx.outputs:
+                if payment_address == tx_out.address:
+                    total_received_satoshi += tx_out.value
+        return total_received_satoshi
+
+    async def get_received_satoshi(self, payment_address: str) -> int:
+        # Общий кэш для /check_payment и фоновой проверки: N опросов одного адреса = один запрос к провайдеру за TTL.
+        return await self.status_cache.get_or_fetch(payment_address, lambda: self._shared_received_satoshi(payment_address))
+
+    async def _shared_received_satoshi(self, payment_address: str) -> int:
+        # Результат видят и остальные воркеры: провайдера опрашивает один процесс за TTL
+        key = f"btc:received:{self.network}:{payment_address}"
+        received = await self.shared_cache.get_json(key)
+        if received is None:
+            received = await self._fetch_received_satoshi(payment_address)
+            await self.shared_cache.set_json(key, received, self.status_cache.ttl)
+        return received
 
-            for tx in transactions:
-                for tx_out in tx.outputs:
-                    if payment_address == tx_out.address:
-                        total_received_satoshi += tx_out.value
-            
+    async def check_address_transactions(self, payment_address: str, required_amount_btc: float, tolerance_percent: float) -> bool:
+        try:
+            total_received_satoshi = await self.get_received_satoshi(payment_address)
             total_received_btc = total_received_satoshi / 100_000_000 
             
             logger.info(f"Address {payment_address} received: {total_received_btc:.8f} BTC. Required: {required_amount_btc:.8f} BTC.")
@@ -341,30 +1150,421 @@ class BitcoinPaymentService:
             return False
 
 
-http_client = AsyncClient()
-bitcoin_payment_service = BitcoinPaymentService(config.BITCOIN_NETWORK)
-telegram_service = TelegramService(config.BOT_API, config.ADMIN_CHAT_ID, http_client)
+class ExchangeRateService:
+    def __init__(self, http_client: AsyncClient, rate_limiter: AsyncRateLimiter, shared_cache: SharedCache, refresh_interval: int, max_staleness: int):
+        self.http_client = http_client
+        self.shared_cache = shared_cache
+        self.rate_limiter = rate_limiter
+        self.refresh_interval = refresh_interval
+        self.max_staleness = timedelta(seconds=max_staleness)
+        self.quote: Optional[ExchangeRateQuote] = None
+        self.last_failed_at: Optional[datetime] = None
+        self._refresh_lock = asyncio.Lock()
+
+    async def _fetch_coingecko(self) -> float:
+        response = await self.http_client.get("https://api.coingecko.com/api/v3/simple/price?ids=bitcoin&vs_currencies=eur", timeout=config.HTTP_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        return float(data["bitcoin"]["eur"])
+
+    async def _fetch_kraken(self) -> float:
+        response = await self.http_client.get("https://api.kraken.com/0/public/Ticker?pair=XBTEUR", timeout=config.HTTP_TIMEOUT)
+        response.raise_for_status()
+        data = response.json()
+        if data and 'result' in data and 'XXBTZEUR' in data['result'] and 'c' in data['result']['XXBTZEUR']:
+            return float(data['result']['XXBTZEUR']['c'][0])
+        raise ValueError("Kraken API response invalid or missing expected data.")
+
+    async def refresh(self) -> Optional[ExchangeRateQuote]:
+        requested_at = datetime.utcnow()
+        async with self._refresh_lock:
+            # Пока ждали lock, курс мог обновить другой запрос
+            if self.quote is not None and self.quote.fetched_at >= requested_at:
+                return self.quote
+            # ...или уже попытался и не смог: не повторяем запросы к лежащим провайдерам за каждого ожидающего
+            if self.last_failed_at is not None and self.last_failed_at >= requested_at:
+                return None
 
+            # Свежий курс мог уже получить другой воркер
+            shared_quote = await self.shared_cache.get_json("exchange_rate:btc_eur")
+            if shared_quote is not None:
+                shared_quote = ExchangeRateQuote.model_validate(shared_quote)
+                if datetime.utcnow() - shared_quote.fetched_at < timedelta(seconds=self.refresh_interval):
+                    self.quote = shared_quote
+                    return self.quote
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("LIFESPAN: Initializing database.")
+            await self.rate_limiter.acquire()
+            try:
+                rate = await self._fetch_coingecko()
+                source = "coingecko"
+            except Exception as e:
+                logger.warning(f"CoinGecko API failed ({e}). Trying backup exchange rate API.")
+                try:
+                    rate = await self._fetch_kraken()
+                    source = "kraken"
+                except Exception as e:
+                    logger.error(f"Both CoinGecko and Kraken APIs failed to retrieve BTC/EUR rate: {e}")
+                    self.last_failed_at = datetime.utcnow()
+                    return None
+
+            self.quote = ExchangeRateQuote(rate=rate, source=source, fetched_at=datetime.utcnow())
+            await self.shared_cache.set_json("exchange_rate:btc_eur", self.quote.model_dump(mode="json"), self.max_staleness.total_seconds())
+            logger.info(f"Received BTC/EUR rate from {source}: {rate}")
+            return self.quote
+
+    async def get_quote(self) -> ExchangeRateQuote:
+        quote = self.quote
+        if quote is None or datetime.utcnow() - quote.fetched_at > self.max_staleness:
+            quote = await self.refresh() or self.quote
+        if quote is None or datetime.utcnow() - quote.fetched_at > self.max_staleness:
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail="Failed to retrieve a fresh BTC exchange rate from any source.")
+        return quote
+
+    async def refresh_periodically(self):
+        while True:
+            try:
+                await self.refresh()
+                await asyncio.sleep(self.refresh_interval)
+            except asyncio.CancelledError:
+                logger.info("refresh_periodically (exchange rate) task cancelled.")
+                break
+            except Exception as e:
+                logger.error(f"Error refreshing BTC/EUR exchange rate: {e}", exc_info=True)
+                await asyncio.sleep(self.refresh_interval)
+
+
+http_client = AsyncClient(transport=InstrumentedTransport(AsyncHTTPTransport()))
+shared_cache = SharedCache(
+    LRUCache(config.CACHE_MAX_ENTRIES, config.CACHE_MAX_BYTES),
+    config.CACHE_REDIS_URL,
+    config.CACHE_NAMESPACE,
+    config.CACHE_LOCAL_TTL,
+    config.WORKER_ID,
+)
+bitcoin_executor = BlockingExecutor("bitcoinlib", config.BITCOIN_EXECUTOR_WORKERS, config.BITCOIN_EXECUTOR_MAX_QUEUE, config.BITCOIN_CALL_TIMEOUT)
+bitcoin_rate_limiter = AsyncRateLimiter(config.PAYMENT_PROVIDER_RATE_LIMIT, config.PAYMENT_PROVIDER_BURST)
+payment_status_cache = SingleFlightCache(config.PAYMENT_STATUS_CACHE_TTL)
+bitcoin_payment_service = BitcoinPaymentService(config.BITCOIN_NETWORK, bitcoin_executor, bitcoin_rate_limiter, payment_status_cache, shared_cache)
+telegram_service = TelegramService(config.BOT_API, http_client)
+avatar_cache = AvatarCache(telegram_service, shared_cache, config.AVATAR_CACHE_DIR, config.AVATAR_CACHE_TTL, config.AVATAR_NEGATIVE_TTL)
+exchange_rate_service = ExchangeRateService(
+    http_client,
+    AsyncRateLimiter(config.EXCHANGE_RATE_PROVIDER_RATE_LIMIT, 2),
+    shared_cache,
+    config.EXCHANGE_RATE_REFRESH_INTERVAL,
+    config.EXCHANGE_RATE_MAX_STALENESS,
+)
+
+
+# INSERT ... ON CONFLICT есть и в SQLite, и в PostgreSQL, но конструкция у каждого диалекта своя
+def dialect_insert(model):
+    if engine.dialect.name == "postgresql":
+        return postgresql_insert(model)
+    return sqlite_insert(model)
+
+# ---- Версионированные миграции схемы ----
+# Схема меняется только командой `python simple_api.py migrate`; при старте приложение лишь проверяет версию.
+# Шаги идемпотентны: базы, созданные ещё через create_all, доводятся до нужной версии без ошибок.
+
+def _has_table(sync_conn, table_name: str) -> bool:
+    return inspect(sync_conn).has_table(table_name)
+
+def _add_column(sync_conn, table_name: str, column: Column):
+    if column.name in {existing["name"] for existing in inspect(sync_conn).get_columns(table_name)}:
+        return
+    column_sql = f"{column.name} {column.type.compile(dialect=sync_conn.dialect)}"
+    if column.server_default is not None:
+        column_sql += f" DEFAULT '{column.server_default.arg}'"
+        if not column.nullable:
+            column_sql += " NOT NULL"
+    sync_conn.execute(text(f"ALTER TABLE {table_name} ADD COLUMN {column_sql}"))
+
+def _create_index(sync_conn, name: str, table_name: str, columns: List[str], unique: bool = False):
+    if name in {existing["name"] for existing in inspect(sync_conn).get_indexes(table_name)}:
+        return
+    sync_conn.execute(text(f"CREATE {'UNIQUE ' if unique else ''}INDEX {name} ON {table_name} ({', '.join(columns)})"))
+
+def migration_001_initial_schema(sync_conn):
+    metadata = MetaData()
+    Table(
+        "products", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("name", String, nullable=False, index=True, unique=True),
+        Column("price", Integer, nullable=False),
+        Column("gender", String, nullable=False, index=True),
+        Column("category", String, nullable=False, index=True),
+        Column("image_url", String, nullable=False),
+    )
+    Table(
+        "cart", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("user_id", Integer, nullable=False, index=True),
+        Column("product_id", Integer, ForeignKey("products.id"), nullable=False, index=True),
+        Column("quantity", Integer, nullable=False),
+    )
+    Table(
+        "orders", metadata,
+        Column("id", String, primary_key=True),
+        Column("user_id", Integer, nullable=False, index=True),
+        Column("name", String),
+        Column("telegram_username", String),
+        Column("address", String),
+        Column("postcode", String),
+        Column("city", String),
+        Column("country", String),
+        Column("items", String, nullable=False),
+        Column("total", Integer, nullable=False),
+        Column("status", String, nullable=False, index=True),
+        Column("payment_address", String, index=True),
+        Column("payment_amount", Float),
+        Column("created_at", DateTime, nullable=False),
+    )
+    metadata.create_all(sync_conn, checkfirst=True)
+
+def migration_002_order_payment_schedule(sync_conn):
+    _add_column(sync_conn, "orders", Column("next_check_at", DateTime, nullable=True))
+    _add_column(sync_conn, "orders", Column("check_attempts", Integer, nullable=False, server_default="0"))
+    _create_index(sync_conn, "ix_orders_status_next_check_at", "orders", ["status", "next_check_at"])
+    # Старые неоплаченные заказы попадают в расписание проверок сразу.
+    sync_conn.execute(text("UPDATE orders SET next_check_at = created_at WHERE next_check_at IS NULL AND status = 'unpaid'"))
+
+def migration_003_order_rate_quote(sync_conn):
+    _add_column(sync_conn, "orders", Column("btc_rate_eur", Float, nullable=True))
+    _add_column(sync_conn, "orders", Column("btc_rate_source", String, nullable=True))
+    _add_column(sync_conn, "orders", Column("btc_rate_fetched_at", DateTime, nullable=True))
+
+def migration_004_payment_address_pool(sync_conn):
+    metadata = MetaData()
+    Table(
+        "payment_addresses", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("address", String, nullable=False, unique=True),
+        Column("network", String, nullable=False),
+        Column("wallet_name", String, nullable=False),
+        Column("status", String, nullable=False),
+        Column("order_id", String, index=True),
+        Column("user_id", Integer),
+        Column("created_at", DateTime, nullable=False),
+        Column("claimed_at", DateTime),
+        Index("ix_payment_addresses_network_status_id", "network", "status", "id"),
+    )
+    metadata.create_all(sync_conn, checkfirst=True)
+
+def migration_005_unique_cart_items(sync_conn):
+    # Перед созданием уникального индекса (user_id, product_id) сливаем дубли корзины в одну строку.
+    merged = sync_conn.execute(text(
+        "UPDATE cart SET quantity = ("
+        "  SELECT SUM(duplicate.quantity) FROM cart AS duplicate"
+        "  WHERE duplicate.user_id = cart.user_id AND duplicate.product_id = cart.product_id"
+        ") WHERE id IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id HAVING COUNT(*) > 1)"
+    )).rowcount
+    if merged:
+        sync_conn.execute(text("DELETE FROM cart WHERE id NOT IN (SELECT MIN(id) FROM cart GROUP BY user_id, product_id)"))
+        logger.info(f"MIGRATE: Merged duplicate cart rows for {merged} (user_id, product_id) pairs.")
+    _create_index(sync_conn, "uq_cart_user_id_product_id", "cart", ["user_id", "product_id"], unique=True)
+
+def migration_006_order_items(sync_conn):
+    metadata = MetaData()
+    Table("orders", metadata, Column("id", String, primary_key=True))
+    order_items = Table(
+        "order_items", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("order_id", String, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, index=True),
+        Column("product_id", Integer, nullable=False, index=True),
+        Column("name", String, nullable=False),
+        Column("price", Integer, nullable=False),
+        Column("gender", String, nullable=False),
+        Column("category", String, nullable=False),
+        Column("image_url", String, nullable=False),
+        Column("quantity", Integer, nullable=False),
+    )
+    order_items.create(sync_conn, checkfirst=True)
+
+    # Переносим позиции из старой JSON-колонки orders.items в order_items.
+    rows = sync_conn.execute(text(
+        "SELECT id, items FROM orders WHERE items IS NOT NULL AND items != '[]'"
+        " AND NOT EXISTS (SELECT 1 FROM order_items WHERE order_items.order_id = orders.id)"
+    )).all()
+    backfilled = 0
+    for order_id, items_json in rows:
+        try:
+            parsed_items = json.loads(items_json)
+            if not isinstance(parsed_items, list):
+                raise ValueError("items field is not a JSON list")
+            item_rows = [
+                {
+                    "order_id": order_id,
+                    "product_id": item["id"],
+                    "name": item["name"],
+                    "price": item["price"],
+                    "gender": item["gender"],
+                    "category": item["category"],
+                    "image_url": item["image_url"],
+                    "quantity": item["quantity"],
+                }
+                for item in parsed_items
+            ]
+        except Exception as e:
+            logger.error(f"MIGRATE: Cannot backfill items for order {order_id}: {e}")
+            continue
+        if item_rows:
+            sync_conn.execute(order_items.insert(), item_rows)
+            backfilled += 1
+    if backfilled:
+        logger.info(f"MIGRATE: Backfilled order_items for {backfilled} orders.")
+
+def migration_007_order_history_indexes(sync_conn):
+    _create_index(sync_conn, "ix_orders_created_at_id", "orders", ["created_at", "id"])
+    _create_index(sync_conn, "ix_orders_user_id_created_at_id", "orders", ["user_id", "created_at", "id"])
+    _create_index(sync_conn, "ix_orders_status_created_at_id", "orders", ["status", "created_at", "id"])
+
+def migration_008_notification_outbox(sync_conn):
+    metadata = MetaData()
+    Table(
+        "notification_outbox", metadata,
+        Column("id", Integer, primary_key=True),
+        Column("chat_id", BigInteger, nullable=False),
+        Column("text", String, nullable=False),
+        Column("parse_mode", String, nullable=False),
+        Column("status", String, nullable=False),
+        Column("attempts", Integer, nullable=False),
+        Column("next_attempt_at", DateTime, nullable=False),
+        Column("last_error", String),
+        Column("created_at", DateTime, nullable=False),
+        Column("sent_at", DateTime),
+        Index("ix_notification_outbox_status_next_attempt_at", "status", "next_attempt_at"),
+    )
+    metadata.create_all(sync_conn, checkfirst=True)
+
+def migration_009_product_archive(sync_conn):
+    _add_column(sync_conn, "products", Column("archived_at", DateTime, nullable=True))
+    _create_index(sync_conn, "ix_products_archived_at", "products", ["archived_at"])
+
+def migration_010_job_leases(sync_conn):
+    metadata = MetaData()
+    Table(
+        "job_leases", metadata,
+        Column("name", String, primary_key=True),
+        Column("owner", String, nullable=False),
+        Column("expires_at", DateTime, nullable=False),
+    )
+    metadata.create_all(sync_conn, checkfirst=True)
+
+def migration_011_normalize_sqlite_timestamps(sync_conn):
+    # func.now() в SQLite пишет "YYYY-MM-DD HH:MM:SS", а SQLAlchemy сравнивает с "YYYY-MM-DD HH:MM:SS.ffffff":
+    # как строки старые значения оказываются меньше равных им параметров, и keyset-курсор по created_at зацикливается
+    if sync_conn.dialect.name != "sqlite":
+        return
+    for table_name, column_name in (
+        ("orders", "created_at"),
+        ("orders", "next_check_at"),
+        ("payment_addresses", "created_at"),
+        ("notification_outbox", "created_at"),
+    ):
+        sync_conn.execute(text(
+            f"UPDATE {table_name} SET {column_name} = {column_name} || '.000000' WHERE length({column_name}) = 19"
+        ))
+
+def migration_012_bigint_user_ids(sync_conn):
+    # Telegram user_id давно вышли за 2^31: в PostgreSQL INTEGER переполняется, в SQLite INTEGER и так 64-битный
+    if sync_conn.dialect.name != "postgresql":
+        return
+    for table_name in ("cart", "orders", "payment_addresses"):
+        sync_conn.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN user_id TYPE BIGINT"))
+
+# Новые миграции добавляются только в конец списка; применённые шаги не редактируются.
+MIGRATIONS = [
+    (1, "initial schema", migration_001_initial_schema),
+    (2, "order payment schedule", migration_002_order_payment_schedule),
+    (3, "order exchange-rate quote", migration_003_order_rate_quote),
+    (4, "payment address pool", migration_004_payment_address_pool),
+    (5, "unique cart items", migration_005_unique_cart_items),
+    (6, "normalized order items", migration_006_order_items),
+    (7, "order history indexes", migration_007_order_history_indexes),
+    (8, "notification outbox", migration_008_notification_outbox),
+    (9, "product archive", migration_009_product_archive),
+    (10, "job leases", migration_010_job_leases),
+    (11, "normalize sqlite timestamps", migration_011_normalize_sqlite_timestamps),
+    (12, "bigint user ids", migration_012_bigint_user_ids),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+schema_version_table = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False),
+)
+
+def get_schema_version(sync_conn) -> int:
+    if not _has_table(sync_conn, "schema_version"):
+        return 0
+    return sync_conn.execute(select(func.max(schema_version_table.c.version))).scalar() or 0
+
+def apply_migrations(sync_conn) -> int:
+    schema_version_table.create(sync_conn, checkfirst=True)
+    current_version = get_schema_version(sync_conn)
+    for version, description, migration in MIGRATIONS:
+        if version <= current_version:
+            continue
+        logger.info(f"MIGRATE: Applying migration {version:03d} ({description}).")
+        migration(sync_conn)
+        sync_conn.execute(schema_version_table.insert().values(version=version, description=description, applied_at=datetime.utcnow()))
+        current_version = version
+    return current_version
+
+async def run_migrations():
     async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+        version = await conn.run_sync(apply_migrations)
+    await engine.dispose()
+    logger.info(f"MIGRATE: Database schema is at version {version}.")
+
+def check_schema_version(sync_conn):
+    version = get_schema_version(sync_conn)
+    if version != SCHEMA_VERSION:
+        raise RuntimeError(
+            f"Database schema is at version {version}, but this code expects version {SCHEMA_VERSION}. "
+            f"Run `python simple_api.py migrate` first."
+        )
 
-    payment_checker_task = asyncio.create_task(check_payments_periodically())
-    logger.info("LIFESPAN: Background task check_payments_periodically started.")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("LIFESPAN: Checking database schema version.")
+    async with engine.connect() as conn:
+        await conn.run_sync(check_schema_version)
+    await catalog_cache.ensure_loaded()
+
+    background_tasks = {
+        "check_payments_periodically": asyncio.create_task(check_payments_periodically()),
+        "refresh_exchange_rate": asyncio.create_task(exchange_rate_service.refresh_periodically()),
+        "refill_address_pool": asyncio.create_task(payment_address_pool.refill_periodically()),
+        "send_notifications": asyncio.create_task(notification_outbox.send_periodically()),
+        "cache_invalidations": asyncio.create_task(shared_cache.listen()),
+    }
+    for task_name in background_tasks:
+        logger.info(f"LIFESPAN: Background task {task_name} started.")
 
     yield
 
     logger.info("LIFESPAN: Application shutting down. Cancelling background tasks.")
-    payment_checker_task.cancel()
+    for task_name, task in background_tasks.items():
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            logger.info(f"LIFESPAN: Background task {task_name} cancelled.")
+        except Exception as e:
+            logger.error(f"LIFESPAN: Error cancelling background task {task_name}: {e}")
+
     try:
-        await payment_checker_task
-    except asyncio.CancelledError:
-        logger.info("LIFESPAN: Background task check_payments_periodically cancelled.")
+        await payment_address_pool.lease.release()  # не ждём истечения аренды при штатной остановке
     except Exception as e:
-        logger.error(f"LIFESPAN: Error cancelling background task: {e}")
+        logger.error(f"LIFESPAN: Error releasing job lease: {e}")
+
+    bitcoin_executor.shutdown()
+    logger.info("LIFESPAN: bitcoinlib executor shut down.")
+    await shared_cache.close()
+    await engine.dispose()
 
 app = FastAPI(title="E-commerce API",
               description="API for managing products, carts, and orders, with Bitcoin payment support.",
@@ -377,164 +1577,996 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["ETag", "X-Next-Cursor"],
 )
 
+# Чистый ASGI вместо @app.middleware("http") (BaseHTTPMiddleware): без task group и memory stream на каждый запрос
+class RequestMetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    def _record(self, scope, status_code: int, started: float):
+        # Шаблон маршрута, а не сырой путь: /get_product/{product_id} — одна серия, а не по серии на товар
+        route = scope.get("route")
+        route_path = route.path if route is not None else "unmatched"
+        HTTP_REQUEST_DURATION.labels(scope["method"], route_path).observe(time.perf_counter() - started)
+        HTTP_REQUESTS.labels(scope["method"], route_path, str(status_code)).inc()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        response_started = False
+
+        async def send_with_metrics(message):
+            nonlocal response_started
+            # Как и раньше, длительность — до начала ответа: SSE и стриминг не растягивают гистограмму
+            if message["type"] == "http.response.start":
+                response_started = True
+                self._record(scope, message["status"], started)
+            await send(message)
+
+        HTTP_REQUESTS_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            HTTP_REQUESTS_IN_PROGRESS.dec()
+            if not response_started:
+                # Исключение до ответа: 500 отдаст ServerErrorMiddleware снаружи
+                self._record(scope, 500, started)
+
+app.add_middleware(RequestMetricsMiddleware)
+
 async def get_session() -> AsyncSession:
     async with async_session() as session:
         yield session
 
-async def check_payments_periodically():
-    while True:
-        try:
-            logger.info("Starting payment checking cycle.")
-            async with async_session() as session:
-                unpaid_orders = (await session.execute(
-                    select(Order).where(Order.status == "unpaid")
-                )).scalars().all()
+async def require_admin(x_admin_token: Optional[str] = Header(None)):
+    # Без настроенного токена админские маршруты закрыты полностью
+    if not config.ADMIN_API_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin API is disabled: ADMIN_API_TOKEN is not set.")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), config.ADMIN_API_TOKEN.encode()):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid admin token.")
+
+# Pub/sub смены статуса заказа: SSE-клиенты этого процесса получают её сразу,
+# остальные воркеры — через канал событий SharedCache (если настроен Redis).
+class PaymentEventBus:
+    def __init__(self, shared_cache: SharedCache):
+        self.shared_cache = shared_cache
+        self._subscribers: dict = {}
+        shared_cache.on_event("payment_status", lambda payload: self.deliver(payload["order_id"], payload["status"]))
+
+    def subscribe(self, order_id: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=10)
+        self._subscribers.setdefault(order_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, order_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(order_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[order_id]
 
-                if not unpaid_orders:
-                    logger.info("No unpaid orders to check.")
-                else:
-                    logger.info(f"Found {len(unpaid_orders)} unpaid orders to check.")
+    async def publish(self, order_id: str, order_status: str):
+        self.deliver(order_id, order_status)
+        await self.shared_cache.publish_event("payment_status", {"order_id": order_id, "status": order_status})
 
-                for order_db_obj in unpaid_orders:
-                    logger.info(f"Processing order ID: {order_db_obj.id}, Payment Address: {order_db_obj.payment_address}")
+    def deliver(self, order_id: str, order_status: str):
+        for queue in self._subscribers.get(order_id, ()):
+            try:
+                queue.put_nowait(order_status)
+            except asyncio.QueueFull:
+                logger.warning(f"Payment event queue full for order {order_id}. Dropping '{order_status}' event.")
+
+    def subscriber_count(self) -> int:
+        return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+payment_event_bus = PaymentEventBus(shared_cache)
+
+# Свежие заказы проверяем часто, дальше интервал растёт экспоненциально; старые заказы истекают.
+class PaymentSchedule:
+    def __init__(self, base_delay: int, max_delay: int, ttl_hours: int):
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ttl = timedelta(hours=ttl_hours)
+
+    def next_check_at(self, attempts: int, now: datetime) -> datetime:
+        delay = min(self.base_delay * (2 ** min(max(attempts - 1, 0), 32)), self.max_delay)
+        return now + timedelta(seconds=delay)
+
+    def is_expired(self, created_at: Optional[datetime], now: datetime) -> bool:
+        return created_at is not None and now - created_at >= self.ttl
+
+# Лидерство для задач, которые должны идти ровно в одном процессе (например, пополнение пула адресов).
+class LeaderLease:
+    def __init__(self, name: str, owner: str, ttl: float):
+        self.name = name
+        self.owner = owner
+        self.ttl = ttl
+        self.held = False
+
+    async def acquire(self) -> bool:
+        # Захват или продление одним upsert: строку обновляем, только если она наша или чужая аренда истекла
+        now = datetime.utcnow()
+        statement = dialect_insert(JobLease).values(name=self.name, owner=self.owner, expires_at=now + timedelta(seconds=self.ttl))
+        statement = statement.on_conflict_do_update(
+            index_elements=[JobLease.name],
+            set_={"owner": statement.excluded.owner, "expires_at": statement.excluded.expires_at},
+            where=or_(JobLease.owner == statement.excluded.owner, JobLease.expires_at < now),
+        ).returning(JobLease.owner)
+        async with async_session() as session:
+            owner = (await session.execute(statement)).scalar_one_or_none()
+            await session.commit()
+        if (owner == self.owner) != self.held:
+            logger.info(f"LEASE: Worker {self.owner} {'acquired' if owner == self.owner else 'lost'} lease '{self.name}'.")
+        self.held = owner == self.owner
+        return self.held
+
+    async def release(self):
+        if not self.held:
+            return
+        async with async_session() as session:
+            await session.execute(delete(JobLease).where(JobLease.name == self.name, JobLease.owner == self.owner))
+            await session.commit()
+        self.held = False
+
+class PaymentScanner:
+    def __init__(self, payment_service: BitcoinPaymentService, schedule: PaymentSchedule, concurrency: int, batch_size: int, claim_ttl: float):
+        self.payment_service = payment_service
+        self.schedule = schedule
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.claim_ttl = claim_ttl
+        self.last_cycle: dict = {}
+
+    async def _check_order(self, semaphore: asyncio.Semaphore, order_id: str, payment_address: str, payment_amount: float) -> bool:
+        async with semaphore:
+            try:
+                return await self.payment_service.check_address_transactions(
+                    payment_address,
+                    payment_amount,
+                    config.PAYMENT_TOLERANCE_PERCENT
+                )
+            except Exception as e:
+                logger.error(f"Failed to check payment for order {order_id}: {e}", exc_info=True)
+                return False
+
+    async def scan_once(self) -> dict:
+        started = time.perf_counter()
+        now = datetime.utcnow()
+        # Забираем заказы, у которых подошло время проверки (индекс status + next_check_at), сдвигая next_check_at
+        # на claim_ttl: другие воркеры их не увидят, а если этот процесс упадёт — заказы снова станут доступны.
+        due_ids = (
+            select(Order.id)
+            .where(
+                Order.status == "unpaid",
+                or_(Order.next_check_at.is_(None), Order.next_check_at <= now)
+            )
+            .order_by(Order.next_check_at)
+            .limit(self.batch_size)
+        )
+        if engine.dialect.name == "postgresql":
+            due_ids = due_ids.with_for_update(skip_locked=True)
+        async with async_session() as session:
+            due_orders = (await session.execute(
+                update(Order)
+                .where(Order.id.in_(due_ids))
+                .values(next_check_at=now + timedelta(seconds=self.claim_ttl))
+                .returning(Order.id, Order.payment_address, Order.payment_amount, Order.created_at, Order.check_attempts)
+                .execution_options(synchronize_session=False)
+            )).all()
+            await session.commit()
+
+        if not due_orders:
+            logger.info("No unpaid orders due for checking.")
+        else:
+            logger.info(f"Found {len(due_orders)} unpaid orders due for checking.")
+
+        expired_ids = []
+        checkable = []
+        for order_id, payment_address, payment_amount, created_at, check_attempts in due_orders:
+            if self.schedule.is_expired(created_at, now):
+                expired_ids.append(order_id)
+                continue
+            if not payment_address or payment_amount is None:
+                logger.warning(f"Order {order_id} has no payment address or amount. Skipping.")
+                continue
+            checkable.append((order_id, payment_address, payment_amount, check_attempts or 0))
+
+        # Проверки идут параллельно (семафор + rate limit провайдера), БД не держим открытой во время запросов.
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*[
+            self._check_order(semaphore, order_id, payment_address, payment_amount)
+            for order_id, payment_address, payment_amount, _ in checkable
+        ])
+        paid_ids = []
+        rescheduled = []
+        for (order_id, _, _, check_attempts), is_paid in zip(checkable, results):
+            if is_paid:
+                paid_ids.append(order_id)
+            else:
+                rescheduled.append({
+                    "id": order_id,
+                    "check_attempts": check_attempts + 1,
+                    "next_check_at": self.schedule.next_check_at(check_attempts + 1, now),
+                })
+
+        # Все изменения статусов и расписания за цикл — одним коммитом.
+        if paid_ids or rescheduled or expired_ids:
+            async with async_session() as session:
+                if paid_ids:
+                    # Мы обновляем статус на "paid", но НЕ отправляем уведомление здесь.
+                    # Уведомление будет отправлено, когда пользователь заполнит форму доставки.
+                    await session.execute(
+                        update(Order)
+                        .where(Order.id.in_(paid_ids), Order.status == "unpaid")
+                        .values(status="paid", next_check_at=None)
+                    )
+                if expired_ids:
+                    await session.execute(
+                        update(Order)
+                        .where(Order.id.in_(expired_ids), Order.status == "unpaid")
+                        .values(status="expired", next_check_at=None)
+                    )
+                if rescheduled:
+                    await session.execute(update(Order), rescheduled)
+                await session.commit()
+            if paid_ids:
+                logger.info(f"Orders PAID by background check: {', '.join(paid_ids)}. Delivery details awaiting.")
+            if expired_ids:
+                logger.info(f"Orders expired without payment: {', '.join(expired_ids)}.")
+            for order_id in paid_ids:
+                await payment_event_bus.publish(order_id, "paid")
+            for order_id in expired_ids:
+                await payment_event_bus.publish(order_id, "expired")
+
+        duration = time.perf_counter() - started
+        PAYMENT_SCAN_DURATION.observe(duration)
+        PAYMENT_SCAN_ORDERS.labels("checked").inc(len(checkable))
+        PAYMENT_SCAN_ORDERS.labels("paid").inc(len(paid_ids))
+        PAYMENT_SCAN_ORDERS.labels("expired").inc(len(expired_ids))
+        self.last_cycle = {
+            "orders_due": len(due_orders),
+            "orders_checked": len(checkable),
+            "orders_paid": len(paid_ids),
+            "orders_expired": len(expired_ids),
+            "duration_seconds": round(duration, 3),
+            "orders_per_second": round(len(checkable) / duration, 2) if duration > 0 else 0.0,
+            "finished_at": datetime.utcnow().isoformat(),
+        }
+        logger.info(
+            f"Payment checking cycle finished: {len(checkable)} orders checked, {len(paid_ids)} paid, "
+            f"{len(expired_ids)} expired, {duration:.2f}s ({self.last_cycle['orders_per_second']} orders/s)."
+        )
+        return self.last_cycle
 
-                    if not order_db_obj.payment_address or order_db_obj.payment_amount is None:
-                        logger.warning(f"Order {order_db_obj.id} has no payment address or amount. Skipping.")
-                        continue
+payment_schedule = PaymentSchedule(config.PAYMENT_CHECK_BASE_DELAY, config.PAYMENT_CHECK_MAX_DELAY, config.PAYMENT_ORDER_TTL_HOURS)
+payment_scanner = PaymentScanner(bitcoin_payment_service, payment_schedule, config.PAYMENT_SCAN_CONCURRENCY, config.PAYMENT_SCAN_BATCH_SIZE, config.PAYMENT_CLAIM_TTL)
 
-                    try:
-                        is_paid = await bitcoin_payment_service.check_address_transactions(
-                            order_db_obj.payment_address,
-                            order_db_obj.payment_amount,
-                            config.PAYMENT_TOLERANCE_PERCENT
-                        )
-
-                        if is_paid:
-                            # Мы обновляем статус на "paid", но НЕ отправляем уведомление здесь.
-                            # Уведомление будет отправлено, когда пользователь заполнит форму доставки.
-                            if order_db_obj.status != "paid": # Только если статус меняется на "paid"
-                                order_db_obj.status = "paid"
-                                session.add(order_db_obj)
-                                await session.commit()
-                                await session.refresh(order_db_obj) 
-                                logger.info(f"Order {order_db_obj.id} PAID by background check! Delivery details awaiting.")
-                            else:
-                                logger.info(f"Order {order_db_obj.id} already marked as paid. No action needed.")
-                        else:
-                            logger.info(f"Order {order_db_obj.id} not yet paid. Expected: {order_db_obj.payment_amount:.8f} BTC.")
-
-                    except Exception as e:
-                        logger.error(f"Failed to check payment for order {order_db_obj.id}: {e}", exc_info=True)
-
-            await asyncio.sleep(60) 
+async def check_payments_periodically():
+    while True:
+        try:
+            logger.info("Starting payment checking cycle.")
+            await payment_scanner.scan_once()
+            await asyncio.sleep(config.PAYMENT_CHECK_INTERVAL)
         except asyncio.CancelledError:
             logger.info("check_payments_periodically task cancelled.")
             break
         except Exception as e:
-            logger.critical(f"CRITICAL ERROR in check_payments_periodically loop: {e}. Attempting to continue in 60 seconds.", exc_info=True)
-            await asyncio.sleep(60)
+            logger.critical(f"CRITICAL ERROR in check_payments_periodically loop: {e}. Attempting to continue in {config.PAYMENT_CHECK_INTERVAL} seconds.", exc_info=True)
+            await asyncio.sleep(config.PAYMENT_CHECK_INTERVAL)
+
+class PaymentAddressPool:
+    def __init__(self, payment_service: BitcoinPaymentService, wallet_name: str, low_water: int, target: int, derive_batch: int, refill_interval: int, lease: LeaderLease):
+        self.payment_service = payment_service
+        self.lease = lease
+        self.wallet_name = wallet_name
+        self.low_water = low_water
+        self.target = target
+        self.derive_batch = derive_batch
+        self.refill_interval = refill_interval
+        self._refill_needed = asyncio.Event()
+        self.claimed = 0
+        self.misses = 0
+
+    async def available_count(self, session: AsyncSession) -> int:
+        return (await session.execute(
+            select(func.count(PaymentAddress.id))
+            .where(PaymentAddress.network == self.payment_service.network, PaymentAddress.status == "available")
+        )).scalar_one()
+
+    async def claim(self, session: AsyncSession, order_id: str, user_id: int) -> Optional[str]:
+        # Один UPDATE ... RETURNING по индексу (network, status, id); коммитится вместе с заказом.
+        next_available = (
+            select(PaymentAddress.id)
+            .where(PaymentAddress.network == self.payment_service.network, PaymentAddress.status == "available")
+            .order_by(PaymentAddress.id)
+            .limit(1)
+            .scalar_subquery()
+        )
+        for _ in range(3):
+            address = (await session.execute(
+                update(PaymentAddress)
+                .where(PaymentAddress.id == next_available, PaymentAddress.status == "available")
+                .values(status="assigned", order_id=order_id, user_id=user_id, claimed_at=datetime.utcnow())
+                .returning(PaymentAddress.address)
+            )).scalar_one_or_none()
+            if address:
+                self.claimed += 1
+                return address
+            # Либо пул пуст, либо адрес перехватил параллельный checkout (PostgreSQL) — пробуем ещё раз.
+        self.misses += 1
+        self._refill_needed.set()
+        return None
+
+    async def acquire(self, order_id: str, user_id: int) -> str:
+        # Адрес из пула (короткая отдельная транзакция) или, если пул пуст, генерация на лету.
+        async with async_session() as session:
+            address = await self.claim(session, order_id, user_id)
+            await session.commit()
+        if address:
+            self.note_claimed()
+            return address
+        logger.warning(f"Payment address pool is empty. Deriving address for order {order_id} on the request path.")
+        # Свежий ключ кошелька магазина, сразу записанный в пул как выданный: адрес не достанется второму заказу,
+        # а если заказ не создастся, release() вернёт его в пул
+        address = (await self.payment_service.derive_addresses(self.wallet_name, 1))[0]
+        async with async_session() as session:
+            session.add(PaymentAddress(
+                address=address,
+                network=self.payment_service.network,
+                wallet_name=self.wallet_name,
+                status="assigned",
+                order_id=order_id,
+                user_id=user_id,
+                claimed_at=datetime.utcnow(),
+            ))
+            await session.commit()
+        return address
+
+    async def release(self, address: str):
+        # Заказ не создан — возвращаем адрес в пул, им ещё никто не пользовался.
+        async with async_session() as session:
+            await session.execute(
+                update(PaymentAddress)
+                .where(PaymentAddress.address == address, PaymentAddress.status == "assigned")
+                .values(status="available", order_id=None, user_id=None, claimed_at=None)
+            )
+            await session.commit()
+
+    async def refill(self) -> int:
+        async with async_session() as session:
+            available = await self.available_count(session)
+        if available >= self.low_water:
+            return 0
+
+        added = 0
+        while available + added < self.target:
+            count = min(self.derive_batch, self.target - available - added)
+            addresses = await self.payment_service.derive_addresses(self.wallet_name, count)
+            async with async_session() as session:
+                session.add_all([
+                    PaymentAddress(address=address, network=self.payment_service.network, wallet_name=self.wallet_name, status="available")
+                    for address in addresses
+                ])
+                await session.commit()
+            added += len(addresses)
+        logger.info(f"Payment address pool refilled with {added} addresses ({available + added} available).")
+        return added
+
+    async def refill_periodically(self):
+        while True:
+            try:
+                # Кошелёк один на всех: адреса выводит только процесс-лидер
+                if await self.lease.acquire():
+                    await self.refill()
+            except asyncio.CancelledError:
+                logger.info("refill_periodically (address pool) task cancelled.")
+                break
+            except Exception as e:
+                logger.error(f"Error refilling payment address pool: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._refill_needed.wait(), timeout=self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                logger.info("refill_periodically (address pool) task cancelled.")
+                break
+            self._refill_needed.clear()
+
+    def note_claimed(self):
+        # Проверяем low-water mark не дожидаясь интервала
+        self._refill_needed.set()
+
+    def stats(self) -> dict:
+        return {"claimed": self.claimed, "misses": self.misses, "low_water": self.low_water, "target": self.target}
+
+payment_address_pool = PaymentAddressPool(
+    bitcoin_payment_service,
+    config.ADDRESS_POOL_WALLET_NAME,
+    config.ADDRESS_POOL_LOW_WATER,
+    config.ADDRESS_POOL_TARGET,
+    config.ADDRESS_POOL_DERIVE_BATCH,
+    config.ADDRESS_POOL_REFILL_INTERVAL,
+    LeaderLease("refill_address_pool", config.WORKER_ID, config.JOB_LEASE_TTL),
+)
+
+class NotificationOutbox:
+    def __init__(self, telegram_service: TelegramService, concurrency: int, batch_size: int, base_delay: float, max_delay: float, max_attempts: int, poll_interval: float, claim_ttl: float):
+        self.telegram_service = telegram_service
+        self.claim_ttl = claim_ttl
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self._wakeup = asyncio.Event()
+        self._paused_until = 0.0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.rate_limited = 0
+
+    def enqueue(self, session: AsyncSession, chat_id: int, text: str, parse_mode: str = "HTML") -> Optional[OutboxMessage]:
+        # Сообщение коммитится вместе с вызывающей транзакцией; после commit нужно вызвать notify()
+        if not chat_id:
+            logger.warning("ADMIN_CHAT_ID is not set. Message will not be queued.")
+            return None
+        message = OutboxMessage(chat_id=chat_id, text=text, parse_mode=parse_mode, next_attempt_at=datetime.utcnow())
+        session.add(message)
+        return message
+
+    def notify(self):
+        self._wakeup.set()
+
+    def retry_delay(self, attempts: int) -> float:
+        return min(self.base_delay * 2 ** min(max(attempts - 1, 0), 32), self.max_delay)
+
+    async def _send(self, semaphore: asyncio.Semaphore, message: OutboxMessage) -> dict:
+        result = {"id": message.id, "attempts": message.attempts}
+        async with semaphore:
+            # Telegram ограничивает бота целиком: после 429 не шлём ничего до истечения retry_after
+            paused_for = self._paused_until - time.monotonic()
+            if paused_for > 0:
+                result["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=paused_for)
+                return result
+
+            result["attempts"] = message.attempts + 1
+            try:
+                await self.telegram_service.deliver_message(message.chat_id, message.text, message.parse_mode)
+            except TelegramDeliveryError as e:
+                return self._on_failure(result, message, e)
+            except Exception as e:
+                # Исключение из gather отменило бы результаты всей пачки, включая уже доставленные сообщения
+                logger.error(f"OUTBOX: Unexpected error sending notification {message.id}: {e}", exc_info=True)
+                return self._on_failure(result, message, TelegramDeliveryError(f"unexpected error: {e!r}"))
+
+            self.sent += 1
+            NOTIFICATIONS.labels("sent").inc()
+            result["status"] = "sent"
+            result["sent_at"] = datetime.utcnow()
+            result["last_error"] = None
+            return result
+
+    def _on_failure(self, result: dict, message, error: TelegramDeliveryError) -> dict:
+        result["last_error"] = str(error)[:500]
+        if error.retry_after:
+            self.rate_limited += 1
+            NOTIFICATIONS.labels("rate_limited").inc()
+            self._paused_until = max(self._paused_until, time.monotonic() + error.retry_after)
+            result["attempts"] = message.attempts  # 429 не считаем неудачной попыткой
+            result["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=error.retry_after)
+        elif error.permanent or result["attempts"] >= self.max_attempts:
+            self.failed += 1
+            NOTIFICATIONS.labels("failed").inc()
+            result["status"] = "failed"
+            logger.error(f"OUTBOX: Giving up on notification {message.id} after {result['attempts']} attempts: {error}")
+        else:
+            self.retried += 1
+            NOTIFICATIONS.labels("retried").inc()
+            result["next_attempt_at"] = datetime.utcnow() + timedelta(seconds=self.retry_delay(result["attempts"]))
+            logger.warning(f"OUTBOX: Notification {message.id} failed (attempt {result['attempts']}), will retry: {error}")
+        return result
+
+    async def send_due(self) -> int:
+        # Как и у проверки платежей: сообщения забираются сдвигом next_attempt_at, чтобы каждое отправлял один воркер
+        now = datetime.utcnow()
+        due_ids = (
+            select(OutboxMessage.id)
+            .where(OutboxMessage.status == "pending", OutboxMessage.next_attempt_at <= now)
+            .order_by(OutboxMessage.next_attempt_at, OutboxMessage.id)
+            .limit(self.batch_size)
+        )
+        if engine.dialect.name == "postgresql":
+            due_ids = due_ids.with_for_update(skip_locked=True)
+        async with async_session() as session:
+            messages = (await session.execute(
+                update(OutboxMessage)
+                .where(OutboxMessage.id.in_(due_ids))
+                .values(next_attempt_at=now + timedelta(seconds=self.claim_ttl))
+                .returning(OutboxMessage.id, OutboxMessage.chat_id, OutboxMessage.text, OutboxMessage.parse_mode, OutboxMessage.attempts)
+                .execution_options(synchronize_session=False)
+            )).all()
+            await session.commit()
+        if not messages:
+            return 0
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._send(semaphore, message) for message in messages))
+        async with async_session() as session:
+            await session.execute(update(OutboxMessage), results)
+            await session.commit()
+        return len(messages)
+
+    async def send_periodically(self):
+        while True:
+            try:
+                # Полная пачка — вероятно, есть ещё готовые к отправке сообщения
+                while await self.send_due() >= self.batch_size:
+                    pass
+            except asyncio.CancelledError:
+                logger.info("send_periodically (notification outbox) task cancelled.")
+                break
+            except Exception as e:
+                logger.error(f"Error sending queued notifications: {e}", exc_info=True)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            except asyncio.CancelledError:
+                logger.info("send_periodically (notification outbox) task cancelled.")
+                break
+            self._wakeup.clear()
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "retried": self.retried, "failed": self.failed, "rate_limited": self.rate_limited}
+
+notification_outbox = NotificationOutbox(
+    telegram_service,
+    config.NOTIFICATION_SEND_CONCURRENCY,
+    config.NOTIFICATION_BATCH_SIZE,
+    config.NOTIFICATION_RETRY_BASE_DELAY,
+    config.NOTIFICATION_RETRY_MAX_DELAY,
+    config.NOTIFICATION_MAX_ATTEMPTS,
+    config.NOTIFICATION_POLL_INTERVAL,
+    config.NOTIFICATION_CLAIM_TTL,
+)
+
+# Снимок каталога в памяти процесса: чтения не трогают SQLite, записи обновляют снимок после коммита.
+class CatalogCache:
+    def __init__(self):
+        self._products: dict = {}
+        self._categories_by_gender: dict = {}
+        self._ids_by_gender: dict = {}
+        self._ids_by_category: dict = {}
+        self._loaded = False
+        self._generation = 0
+        self._lock = asyncio.Lock()
+        self._encoded: dict = {}
+
+    async def ensure_loaded(self):
+        if self._loaded:
+            return
+        async with self._lock:
+            while not self._loaded:
+                generation = self._generation
+                async with async_session() as session:
+                    products = (await session.execute(select(Product).where(Product.archived_at.is_(None)).order_by(Product.id))).scalars().all()
+                if generation != self._generation:
+                    continue  # во время загрузки каталог изменился — перечитываем
+                self._products = {product.id: ProductOut.model_validate(product) for product in products}
+                self._rebuild_index()
+                self._loaded = True
+                logger.info(f"Catalog snapshot loaded: {len(self._products)} products.")
+
+    def _rebuild_index(self):
+        categories_by_gender: dict = {}
+        ids_by_gender: dict = {}
+        ids_by_category: dict = {}
+        for product in self._products.values():
+            categories = categories_by_gender.setdefault(product.gender, [])
+            if product.category not in categories:
+                categories.append(product.category)
+            ids_by_gender.setdefault(product.gender, []).append(product.id)
+            ids_by_category.setdefault(product.category, []).append(product.id)
+        self._categories_by_gender = categories_by_gender
+        self._ids_by_gender = ids_by_gender
+        self._ids_by_category = ids_by_category
+        self._encoded = {}
+
+    def put(self, product: ProductOut):
+        self._generation += 1
+        if self._loaded:
+            self._products[product.id] = product
+            self._rebuild_index()
+
+    def remove(self, product_ids):
+        self._generation += 1
+        if self._loaded:
+            for product_id in product_ids:
+                self._products.pop(product_id, None)
+            self._rebuild_index()
+
+    def invalidate(self):
+        self._generation += 1
+        self._loaded = False
+
+    async def product(self, product_id: int) -> Optional[ProductOut]:
+        await self.ensure_loaded()
+        return self._products.get(product_id)
+
+    async def categories(self, gender: str) -> List[str]:
+        await self.ensure_loaded()
+        return list(self._categories_by_gender.get(gender, []))
+
+    async def query_products(
+        self,
+        gender: Optional[str],
+        category: Optional[str],
+        min_price: Optional[int],
+        max_price: Optional[int],
+        sort: str,
+        after: Optional[tuple],
+        limit: Optional[int],
+    ) -> tuple:
+        await self.ensure_loaded()
+        # Те же индексы gender/category, что и в БД, только в памяти
+        if gender is not None and category is not None:
+            category_ids = set(self._ids_by_category.get(category, []))
+            candidate_ids = [product_id for product_id in self._ids_by_gender.get(gender, []) if product_id in category_ids]
+        elif gender is not None:
+            candidate_ids = self._ids_by_gender.get(gender, [])
+        elif category is not None:
+            candidate_ids = self._ids_by_category.get(category, [])
+        else:
+            candidate_ids = list(self._products)
+
+        sort_key = PRODUCT_SORT_KEYS[sort]
+        products = [
+            product for product in (self._products[product_id] for product_id in candidate_ids)
+            if (min_price is None or product.price >= min_price) and (max_price is None or product.price <= max_price)
+        ]
+        products.sort(key=sort_key)
+        if after is not None:
+            products = [product for product in products if sort_key(product) > after]
+
+        next_after = None
+        if limit is not None and len(products) > limit:
+            products = products[:limit]
+            next_after = sort_key(products[-1])
+        return products, next_after
+
+    def encoded(self, key: str, payload) -> dict:
+        # JSON и сжатые варианты считаются один раз на снимок каталога
+        entry = self._encoded.get(key)
+        if entry is not None:
+            return entry
+        body = json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        # Только хэш содержимого: у всех воркеров одинаковый ETag для одинаковых байт
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        entry = {"etag": f"catalog-{digest}", "identity": body}
+        if len(body) >= 512:
+            entry["gzip"] = gzip.compress(body, compresslevel=6)
+            if brotli is not None:
+                entry["br"] = brotli.compress(body)
+        if len(self._encoded) < 1000:  # не даём произвольным комбинациям фильтров раздуть кэш
+            self._encoded[key] = entry
+        return entry
+
+# Ключ сортировки для keyset-пагинации: (значение, id) — id делает порядок однозначным
+PRODUCT_SORT_KEYS = {
+    "id": lambda product: (product.id,),
+    "price_asc": lambda product: (product.price, product.id),
+    "price_desc": lambda product: (-product.price, product.id),
+}
+
+def encode_cursor(sort: str, after: tuple) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort, *after]).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        cursor_sort, *after = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+    if cursor_sort != sort or not all(isinstance(value, int) for value in after):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Cursor does not match the requested sort order.")
+    return tuple(after)
+
+catalog_cache = CatalogCache()
+# Каталог изменил другой воркер — перечитываем снимок из БД при следующем запросе
+shared_cache.on_invalidate("catalog", catalog_cache.invalidate)
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates or f"W/{etag}" in candidates
+
+def catalog_response(request: Request, entry: dict) -> Response:
+    accept_encoding = request.headers.get("accept-encoding", "")
+    encoding = next((encoding for encoding in ("br", "gzip") if encoding in entry and encoding in accept_encoding), "identity")
+    # Сильный ETag — на конкретные байты, поэтому у сжатых вариантов свой суффикс
+    etag = f'"{entry["etag"]}"' if encoding == "identity" else f'"{entry["etag"]}-{encoding}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    if encoding != "identity":
+        headers["Content-Encoding"] = encoding
+    return Response(content=entry[encoding], media_type="application/json", headers=headers)
 
 @app.get("/", summary="API Status Check")
 async def root():
     return {"message": "Authorization successful!"}
 
+@app.get("/get_executor_stats/", summary="bitcoinlib executor pool, queue-depth and payment scan metrics")
+async def get_executor_stats():
+    return {
+        "worker_id": config.WORKER_ID,
+        "address_pool_leader": payment_address_pool.lease.held,
+        "bitcoin_executor": bitcoin_executor.stats(),
+        "payment_status_cache": payment_status_cache.stats(),
+        "payment_event_subscribers": payment_event_bus.subscriber_count(),
+        "payment_address_pool": payment_address_pool.stats(),
+        "avatar_cache": avatar_cache.stats(),
+        "shared_cache": shared_cache.stats(),
+        "notification_outbox": notification_outbox.stats(),
+        "last_payment_scan": payment_scanner.last_cycle,
+    }
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    registry = REGISTRY
+    if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(content=generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/get_exchange_rate/", response_model=ExchangeRateQuote, summary="Current cached BTC/EUR exchange rate")
+async def get_exchange_rate():
+    return await exchange_rate_service.get_quote()
+
 @app.post("/add_product/", response_model=ProductOut, status_code=status.HTTP_201_CREATED, summary="Add a new product")
 async def add_product(product: ProductIn, session: AsyncSession = Depends(get_session)):
-    existing_product = await session.execute(
-        select(Product)
-        .where(Product.name == product.name)
-        .where(Product.category == product.category)
-        .where(Product.gender == product.gender)
-    )
-    if existing_product.scalars().first():
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Product with this name, category, and gender already exists.")
-
-    db_product = Product(**product.model_dump())
-    session.add(db_product)
+    # name уникален по всей таблице, включая архив: ищем строку только по нему
+    db_product = (await session.execute(select(Product).where(Product.name == product.name))).scalars().first()
+    if db_product is not None and db_product.archived_at is None:
+        if db_product.category == product.category and db_product.gender == product.gender:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Product with this name, category, and gender already exists.")
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Product with this name already exists in another category or gender.")
+
+    if db_product is None:
+        db_product = Product(**product.model_dump())
+        session.add(db_product)
+    else:
+        # Архивный товар возвращается в каталог с новыми данными, как при повторном bulk-импорте
+        for field, value in product.model_dump().items():
+            setattr(db_product, field, value)
+        db_product.archived_at = None
+    restored = db_product.id is not None
     await session.commit()
     await session.refresh(db_product)
-    logger.info(f"New product added: {db_product.name}")
+    catalog_cache.put(ProductOut.model_validate(db_product))
+    await shared_cache.invalidate("catalog")
+    logger.info(f"{'Archived product restored' if restored else 'New product added'}: {db_product.name}")
     return db_product
 
-@app.get("/get_products/", response_model=List[ProductOut], summary="Get all products") 
-async def get_products(session: AsyncSession = Depends(get_session)):
-    products = (await session.execute(select(Product))).scalars().all()
-    return products
+# Тело запроса читается по кускам: в памяти только текущая строка и текущая пачка товаров
+async def iter_body_lines(request: Request):
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    buffer = ""
+    line_number = 0
+    async for chunk in request.stream():
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split("\n")
+        for line in lines:
+            line_number += 1
+            yield line_number, line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield line_number + 1, buffer.rstrip("\r")
+
+async def iter_import_rows(request: Request, import_format: str):
+    if import_format == "ndjson":
+        async for line_number, line in iter_body_lines(request):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield line_number, None, f"Invalid JSON: {e}"
+                continue
+            if not isinstance(row, dict):
+                yield line_number, None, "Expected a JSON object."
+                continue
+            yield line_number, row, None
+        return
+
+    header = None
+    record = ""
+    record_line = 0
+    async for line_number, line in iter_body_lines(request):
+        if not record:
+            if not line.strip():
+                continue
+            record_line = line_number
+            record = line
+        else:
+            record += "\n" + line
+        if record.count('"') % 2:
+            continue  # кавычка не закрыта: поле продолжается на следующей строке
+        values = next(csv.reader([record]))
+        record = ""
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+        if len(values) != len(header):
+            yield record_line, None, f"Expected {len(header)} columns, got {len(values)}."
+            continue
+        yield record_line, dict(zip(header, values)), None
+    if record:
+        yield record_line, None, "Unterminated quoted field."
+
+async def upsert_products(session: AsyncSession, rows_by_name: dict, report: ProductImportReport):
+    existing_names = set((await session.execute(select(Product.name).where(Product.name.in_(rows_by_name)))).scalars().all())
+    statement = dialect_insert(Product)
+    statement = statement.on_conflict_do_update(
+        index_elements=[Product.name],
+        # Повторный импорт архивного товара возвращает его в каталог
+        set_={**{column: statement.excluded[column] for column in ("price", "gender", "category", "image_url")}, "archived_at": None},
+    )
+    await session.execute(statement, list(rows_by_name.values()))
+    await session.commit()
+    report.created += len(rows_by_name) - len(existing_names)
+    report.updated += len(existing_names)
+
+@app.post("/products/bulk", response_model=ProductImportReport, summary="Bulk upsert products from a streamed NDJSON or CSV body")
+async def bulk_upsert_products(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+    session: AsyncSession = Depends(get_session),
+):
+    import_format = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+    report = ProductImportReport()
+    batch: dict = {}
+
+    async for line_number, row, error in iter_import_rows(request, import_format):
+        report.rows += 1
+        if error is None:
+            try:
+                product = ProductIn.model_validate(row)
+            except ValidationError as e:
+                error = "; ".join(f"{'.'.join(str(part) for part in err['loc'])}: {err['msg']}" for err in e.errors())
+        if error is not None:
+            report.failed += 1
+            if len(report.errors) < config.PRODUCT_IMPORT_MAX_ERRORS:
+                report.errors.append(ProductImportError(line=line_number, error=error))
+            else:
+                report.errors_truncated = True
+            continue
+
+        # Ключ — name: повтор имени в пределах пачки перезаписывает предыдущую строку
+        batch[product.name] = product.model_dump()
+        if len(batch) >= config.PRODUCT_IMPORT_BATCH_SIZE:
+            await upsert_products(session, batch, report)
+            batch = {}
+
+    if batch:
+        await upsert_products(session, batch, report)
+    if report.created or report.updated:
+        catalog_cache.invalidate()
+        await shared_cache.invalidate("catalog")
+    logger.info(f"Bulk product import ({import_format}): {report.rows} rows, {report.created} created, {report.updated} updated, {report.failed} failed.")
+    return report
+
+@app.get("/get_products/", response_model=List[ProductOut], summary="Get products with optional filters, pagination and field projection") 
+async def get_products(
+    request: Request,
+    gender: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[int] = Query(None, ge=0),
+    max_price: Optional[int] = Query(None, ge=0),
+    sort: str = Query("id", pattern="^(id|price_asc|price_desc)$"),
+    limit: Optional[int] = Query(None, gt=0, le=500),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+):
+    selected_fields = None
+    if fields:
+        selected_fields = [field.strip() for field in fields.split(",") if field.strip()]
+        unknown_fields = set(selected_fields) - set(ProductOut.model_fields)
+        if unknown_fields:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}.")
+
+    after = decode_cursor(cursor, sort) if cursor else None
+    products, next_after = await catalog_cache.query_products(gender, category, min_price, max_price, sort, after, limit)
+
+    cache_key = f"products:{gender}:{category}:{min_price}:{max_price}:{sort}:{limit}:{cursor}:{fields}"
+    entry = catalog_cache.encoded(cache_key, [
+        product.model_dump(mode="json", include=set(selected_fields) if selected_fields else None)
+        for product in products
+    ])
+    response = catalog_response(request, entry)
+    # Тело остаётся JSON-массивом для старых клиентов; курсор следующей страницы — в заголовке
+    if next_after is not None:
+        response.headers["X-Next-Cursor"] = encode_cursor(sort, next_after)
+    return response
 
 @app.get("/get_product/{product_id}", response_model=ProductOut, summary="Get product by ID")
-async def get_product(product_id: int, session: AsyncSession = Depends(get_session)):
-    result = await session.execute(select(Product).where(Product.id == product_id))
-    product = result.scalar_one_or_none()
+async def get_product(product_id: int, request: Request):
+    product = await catalog_cache.product(product_id)
     if product is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-    return product
-
-@app.get("/get_categories/", summary="Get product categories by gender") 
-async def get_categories(gender: str = "unisex", session: AsyncSession = Depends(get_session)):
-    categories = [row[0] for row in (await session.execute(
-        select(distinct(Product.category)).where(Product.gender == gender)
-    )).all()]
-    return categories
-
-@app.delete("/del_product/{product_id}", status_code=status.HTTP_204_NO_CONTENT, summary="Delete product by ID")
-async def delete_product(product_id: int, session: AsyncSession = Depends(get_session)):
-    product = (await session.execute(select(Product).where(Product.id == product_id))).scalars().one_or_none()
-    if not product:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
-    await session.delete(product)
+    entry = catalog_cache.encoded(f"product:{product_id}", product.model_dump(mode="json"))
+    return catalog_response(request, entry)
+
+@app.get("/get_categories/", response_model=List[str], summary="Get product categories by gender") 
+async def get_categories(request: Request, gender: str = "unisex"):
+    categories = await catalog_cache.categories(gender)
+    entry = catalog_cache.encoded(f"categories:{gender}", categories)
+    return catalog_response(request, entry)
+
+async def remove_products(session: AsyncSession, product_filter, archive: bool) -> List[int]:
+    # Набором, без загрузки товаров в память: корзины чистим в той же транзакции
+    matching_ids = select(Product.id).where(product_filter, Product.archived_at.is_(None))
+    await session.execute(delete(CartItem).where(CartItem.product_id.in_(matching_ids)))
+    if archive:
+        statement = update(Product).where(product_filter, Product.archived_at.is_(None)).values(archived_at=datetime.utcnow())
+    else:
+        statement = delete(Product).where(product_filter)
+    removed_ids = (await session.execute(statement.returning(Product.id).execution_options(synchronize_session=False))).scalars().all()
     await session.commit()
-    logger.info(f"Product with ID {product_id} deleted.")
+    catalog_cache.remove(removed_ids)
+    await shared_cache.invalidate("catalog")
+    return removed_ids
+
+@app.delete("/del_product/{product_id}", status_code=status.HTTP_204_NO_CONTENT, summary="Delete or archive product by ID")
+async def delete_product(product_id: int, archive: bool = False, session: AsyncSession = Depends(get_session)):
+    if not await remove_products(session, Product.id == product_id, archive):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found")
+    logger.info(f"Product with ID {product_id} {'archived' if archive else 'deleted'}.")
     return
 
-@app.delete("/del_category/{category_name}", status_code=status.HTTP_204_NO_CONTENT, summary="Delete category and all products within it")
-async def delete_category(category_name: str, session: AsyncSession = Depends(get_session)):
-    products_in_category = (await session.execute(select(Product).where(Product.category == category_name))).scalars().all()
-    if not products_in_category:
+@app.delete("/del_category/{category_name}", status_code=status.HTTP_204_NO_CONTENT, summary="Delete or archive category and all products within it")
+async def delete_category(category_name: str, archive: bool = False, session: AsyncSession = Depends(get_session)):
+    removed_ids = await remove_products(session, Product.category == category_name, archive)
+    if not removed_ids:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Category '{category_name}' not found or is empty.")
-
-    for product in products_in_category:
-        await session.delete(product)
-    await session.commit()
-    logger.info(f"Category '{category_name}' and all its products deleted.")
+    logger.info(f"Category '{category_name}' and all its {len(removed_ids)} products {'archived' if archive else 'deleted'}.")
     return
 
 @app.get("/get_user_avatar/{user_id}", summary="Get Telegram user avatar")
-async def get_avatar(user_id: int):
-    file_id = await telegram_service.get_user_profile_photos(user_id)
-    if not file_id:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Avatar not found")
-
-    file_path = await telegram_service.get_file_path(file_id)
-    if not file_path:
-        raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to get avatar file path")
+async def get_avatar(user_id: int, request: Request):
+    avatar = await avatar_cache.get(user_id)
+    if avatar is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Avatar not found",
+            headers={"Cache-Control": f"public, max-age={config.AVATAR_NEGATIVE_TTL}"},
+        )
 
-    return await telegram_service.download_file(file_path)
+    etag = f'"avatar-{avatar["digest"][:32]}"'
+    headers = {"ETag": etag, "Cache-Control": f"public, max-age={config.AVATAR_CACHE_TTL}"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return FileResponse(avatar_cache.path_for(avatar["digest"]), media_type=avatar["content_type"], headers=headers)
 
 @app.post("/add_to_cart/", status_code=status.HTTP_200_OK, summary="Add item to cart")
 async def add_to_cart(user_id: int, product_id: int, quantity: int = 1, session: AsyncSession = Depends(get_session)):
     if quantity <= 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Quantity must be a positive number.")
 
-    product_exists = await session.execute(select(Product).where(Product.id == product_id))
-    if not product_exists.scalars().first():
+    if await catalog_cache.product(product_id) is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Product not found.")
 
-    cart_item = (await session.execute(
-        select(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id)
-    )).scalar_one_or_none()
-
-    if cart_item:
-        cart_item.quantity += quantity
-        session.add(cart_item)
-        logger.info(f"Quantity of product {product_id} in user {user_id}'s cart updated to {cart_item.quantity}.")
-    else:
-        db_cart_item = CartItem(user_id=user_id, product_id=product_id, quantity=quantity)
-        session.add(db_cart_item)
-        logger.info(f"Product {product_id} added to user {user_id}'s cart with quantity {quantity}.")
-
+    await upsert_cart_quantity(session, user_id, product_id, quantity, increment=True)
     await session.commit()
+    logger.info(f"Product {product_id} added to user {user_id}'s cart (+{quantity}).")
     return {"message": "Item added/updated in cart."}
 
 @app.delete("/del_from_cart/", status_code=status.HTTP_200_OK, summary="Remove item from cart")
@@ -542,24 +2574,70 @@ async def del_from_cart(user_id: int, product_id: int, quantity: int = 1, sessio
     if quantity <= 0:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Quantity must be a positive number.")
 
-    cart_item = (await session.execute(
-        select(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id)
+    remaining = (await session.execute(
+        update(CartItem)
+        .where(CartItem.user_id == user_id, CartItem.product_id == product_id)
+        .values(quantity=CartItem.quantity - quantity)
+        .returning(CartItem.quantity)
     )).scalar_one_or_none()
 
-    if not cart_item:
+    if remaining is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Item not found in user's cart.")
 
-    if cart_item.quantity > quantity:
-        cart_item.quantity -= quantity
-        session.add(cart_item)
-        logger.info(f"Quantity of product {product_id} in user {user_id}'s cart reduced to {cart_item.quantity}.")
+    if remaining > 0:
+        logger.info(f"Quantity of product {product_id} in user {user_id}'s cart reduced to {remaining}.")
     else:
-        await session.delete(cart_item)
+        await session.execute(
+            delete(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == product_id, CartItem.quantity <= 0)
+        )
         logger.info(f"Product {product_id} completely removed from user {user_id}'s cart.")
 
     await session.commit()
     return {"message": "Item removed from cart."}
 
+async def upsert_cart_quantity(session: AsyncSession, user_id: int, product_id: int, quantity: int, increment: bool):
+    # Атомарно в SQL: без SELECT и без read-modify-write в Python, опираясь на уникальный индекс (user_id, product_id).
+    if increment and quantity <= 0:
+        await session.execute(
+            update(CartItem)
+            .where(CartItem.user_id == user_id, CartItem.product_id == product_id)
+            .values(quantity=CartItem.quantity + quantity)
+        )
+        return
+    statement = dialect_insert(CartItem).values(user_id=user_id, product_id=product_id, quantity=quantity)
+    statement = statement.on_conflict_do_update(
+        index_elements=[CartItem.user_id, CartItem.product_id],
+        set_={"quantity": CartItem.quantity + statement.excluded.quantity if increment else statement.excluded.quantity},
+    )
+    await session.execute(statement)
+
+@app.post("/cart/{user_id}/batch", response_model=List[CartProductOut], summary="Apply several cart operations in one transaction")
+async def cart_batch(user_id: int, batch: CartBatchIn, session: AsyncSession = Depends(get_session)):
+    for operation in batch.operations:
+        if operation.op == "set" and operation.quantity < 0:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Quantity for 'set' must not be negative (product {operation.product_id}).")
+
+    # Одна проверка существования товаров на весь пакет
+    product_ids = {operation.product_id for operation in batch.operations if operation.op != "remove"}
+    if product_ids:
+        existing_ids = set((await session.execute(
+            select(Product.id).where(Product.id.in_(product_ids), Product.archived_at.is_(None))
+        )).scalars().all())
+        missing_ids = product_ids - existing_ids
+        if missing_ids:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"Products not found: {', '.join(map(str, sorted(missing_ids)))}.")
+
+    for operation in batch.operations:
+        if operation.op == "remove" or (operation.op == "set" and operation.quantity == 0):
+            await session.execute(delete(CartItem).where(CartItem.user_id == user_id, CartItem.product_id == operation.product_id))
+        else:
+            await upsert_cart_quantity(session, user_id, operation.product_id, operation.quantity, increment=operation.op == "increment")
+
+    await session.execute(delete(CartItem).where(CartItem.user_id == user_id, CartItem.quantity <= 0))
+    await session.commit()
+    logger.info(f"Applied {len(batch.operations)} cart operations for user {user_id}.")
+    return await get_cart(user_id, session)
+
 @app.get("/get_cart/{user_id}", response_model=List[CartProductOut], summary="Get user's cart contents") 
 async def get_cart(user_id: int, session: AsyncSession = Depends(get_session)):
     result = await session.execute(
@@ -582,60 +2660,125 @@ async def get_cart(user_id: int, session: AsyncSession = Depends(get_session)):
 
 @app.post("/create_order/", response_model=OrderOut, status_code=status.HTTP_201_CREATED, summary="Create a new order")
 async def create_order(order_in: OrderIn, session: AsyncSession = Depends(get_session)):
-    cart_items = await get_cart(order_in.user_id, session)
-    if not cart_items:
+    cart_not_empty = (await session.execute(
+        select(CartItem.id).where(CartItem.user_id == order_in.user_id).limit(1)
+    )).first()
+    await session.rollback()
+    if not cart_not_empty:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User's cart is empty. Cannot create order.")
-    
-    btc_rate_eur = await bitcoin_payment_service.get_btc_exchange_rate()
-    payment_address = await bitcoin_payment_service.generate_new_payment_address(order_in.user_id)
-    amount_required_btc = order_in.total / btc_rate_eur 
-    
-    items_json_string = json.dumps([item.model_dump() for item in order_in.items])
-
-    order_db = Order( 
-        user_id=order_in.user_id,
-        name=None, 
-        telegram_username=None, 
-        address=None,
-        postcode=None,
-        city=None,
-        country=None,
-        total=order_in.total,
-        status="unpaid", 
-        payment_address=payment_address,
-        payment_amount=amount_required_btc,
-        items=items_json_string,
+
+    # Медленные внешние шаги — параллельно и до открытия транзакции
+    order_id = str(uuid.uuid4())
+    quote_result, address_result = await asyncio.gather(
+        exchange_rate_service.get_quote(),
+        payment_address_pool.acquire(order_id, order_in.user_id),
+        return_exceptions=True,
     )
-    
-    session.add(order_db)
-    await session.commit()
-    await session.refresh(order_db)
+    if isinstance(address_result, BaseException):
+        raise address_result
+    payment_address = address_result
+    if isinstance(quote_result, BaseException):
+        await payment_address_pool.release(payment_address)
+        raise quote_result
+    btc_quote = quote_result
+
+    try:
+        # Одна транзакция: забираем корзину (DELETE ... RETURNING), считаем цены по таблице товаров, создаём заказ.
+        cart_rows = (await session.execute(
+            delete(CartItem)
+            .where(CartItem.user_id == order_in.user_id)
+            .returning(CartItem.product_id, CartItem.quantity)
+        )).all()
+        quantities: dict = {}
+        for product_id, quantity in cart_rows:
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        products = (await session.execute(
+            select(Product).where(Product.id.in_(quantities), Product.archived_at.is_(None)).order_by(Product.id)
+        )).scalars().all()
+        order_items = [
+            CartProductOut(
+                id=product.id,
+                name=product.name,
+                price=product.price,
+                gender=product.gender,
+                category=product.category,
+                image_url=product.image_url,
+                quantity=quantities[product.id]
+            )
+            for product in products
+            if quantities[product.id] > 0
+        ]
+        if not order_items:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="User's cart is empty. Cannot create order.")
+
+        total = sum(item.price * item.quantity for item in order_items)
+        if total != order_in.total:
+            logger.warning(f"Client total {order_in.total} for user {order_in.user_id} differs from server total {total}. Using server total.")
+        amount_required_btc = total / btc_quote.rate
+
+        order_db = Order( 
+            id=order_id,
+            user_id=order_in.user_id,
+            name=None, 
+            telegram_username=None, 
+            address=None,
+            postcode=None,
+            city=None,
+            country=None,
+            total=total,
+            status="unpaid", 
+            payment_address=payment_address,
+            payment_amount=amount_required_btc,
+            order_items=[
+                OrderItem(
+                    product_id=item.id,
+                    name=item.name,
+                    price=item.price,
+                    gender=item.gender,
+                    category=item.category,
+                    image_url=item.image_url,
+                    quantity=item.quantity
+                )
+                for item in order_items
+            ],
+            created_at=datetime.utcnow(),
+            next_check_at=datetime.utcnow(),
+            check_attempts=0,
+            btc_rate_eur=btc_quote.rate,
+            btc_rate_source=btc_quote.source,
+            btc_rate_fetched_at=btc_quote.fetched_at,
+        )
+        session.add(order_db)
+        await session.commit()
+    except BaseException:
+        await session.rollback()
+        await payment_address_pool.release(payment_address)
+        raise
 
     # Уведомление о создании заказа здесь удалено.
     # Оно будет отправлено только после того, как заказ будет оплачен И данные доставки будут заполнены.
-
-    await session.execute(
-        delete(CartItem).where(CartItem.user_id == order_in.user_id)
-    )
-    await session.commit()
     logger.info(f"Order {order_db.id} successfully created for user {order_in.user_id}. Cart cleared.")
 
-    return OrderOut.from_orm_with_items_parsed(order_db)
+    return OrderOut.from_orm_with_items(order_db)
 
 @app.get("/get_order_details/{order_id}", response_model=OrderOut, summary="Get order details by ID")
 async def get_order_details(order_id: str, session: AsyncSession = Depends(get_session)):
-    order_db_obj = (await session.execute(select(Order).where(Order.id == order_id))).scalars().first()
+    order_db_obj = (await session.execute(
+        select(Order).where(Order.id == order_id).options(selectinload(Order.order_items))
+    )).scalars().first()
     if not order_db_obj:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found.")
     
-    return OrderOut.from_orm_with_items_parsed(order_db_obj)
+    return OrderOut.from_orm_with_items(order_db_obj)
 
 @app.put("/update_order_delivery/", response_model=OrderOut, summary="Update delivery information for an order")
 async def update_order_delivery(
     delivery_data: UpdateOrderDeliveryIn, 
     session: AsyncSession = Depends(get_session)
 ):
-    order_db_obj = (await session.execute(select(Order).where(Order.id == delivery_data.order_id))).scalars().first()
+    order_db_obj = (await session.execute(
+        select(Order).where(Order.id == delivery_data.order_id).options(selectinload(Order.order_items))
+    )).scalars().first()
     if not order_db_obj:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found.")
 
@@ -655,14 +2798,9 @@ async def update_order_delivery(
     order_db_obj.city = delivery_data.city
     order_db_obj.country = delivery_data.country
 
-    await session.commit()
-    await session.refresh(order_db_obj) # Обновляем объект для получения актуальных данных
-
-    logger.info(f"Delivery information updated for order {order_db_obj.id}.")
-
     # ОТПРАВКА ПОДРОБНОГО УВЕДОМЛЕНИЯ АДМИНУ ПОСЛЕ ЗАПОЛНЕНИЯ ФОРМЫ И ОПЛАТЫ
     # Это уведомление теперь будет единственным и полным.
-    order_out = OrderOut.from_orm_with_items_parsed(order_db_obj) # Парсим для удобства
+    order_out = OrderOut.from_orm_with_items(order_db_obj) # Парсим для удобства
 
     items_summary = "\n".join([
         f"- {item.name} (x{item.quantity}) = €{item.price * item.quantity:.2f}" 
@@ -671,7 +2809,9 @@ async def update_order_delivery(
 
     telegram_info = order_out.telegram_username if order_out.telegram_username else "Не указан"
 
-    await telegram_service.send_message(
+    # Сообщение сохраняется в outbox в той же транзакции, что и данные доставки; отправит его фоновый воркер
+    notification_outbox.enqueue(
+            session,
             chat_id=config.ADMIN_CHAT_ID,
             text=(
                 f"📦 **New Paid Order with Delivery!**\n"
@@ -691,8 +2831,116 @@ async def update_order_delivery(
             ),
             parse_mode="Markdown"
         )
+
+    await session.commit() # expire_on_commit=False: объект уже содержит актуальные данные
+    notification_outbox.notify()
+
+    logger.info(f"Delivery information updated for order {order_db_obj.id}.")
     
-    return OrderOut.from_orm_with_items_parsed(order_db_obj)
+    return OrderOut.from_orm_with_items(order_db_obj)
+
+ORDER_EXPORT_COLUMNS = [
+    "id", "user_id", "status", "total", "payment_address", "payment_amount",
+    "btc_rate_eur", "btc_rate_source", "name", "telegram_username",
+    "address", "postcode", "city", "country", "created_at",
+]
+
+def encode_order_cursor(created_at: datetime, order_id: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([created_at.isoformat(), order_id]).encode("utf-8")).decode("ascii")
+
+def decode_order_cursor(cursor: str) -> tuple:
+    try:
+        created_at, order_id = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+        return to_naive_utc(datetime.fromisoformat(created_at)), str(order_id)
+    except Exception:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor.")
+
+def to_naive_utc(value: datetime) -> datetime:
+    # Колонки хранят наивное UTC: SQLite молча отбросил бы смещение, а asyncpg не привяжет aware к timestamp
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
+
+def filter_orders(statement, user_id: Optional[int], order_status: Optional[str], since: Optional[datetime], until: Optional[datetime]):
+    if user_id is not None:
+        statement = statement.where(Order.user_id == user_id)
+    if order_status is not None:
+        statement = statement.where(Order.status == order_status)
+    if since is not None:
+        statement = statement.where(Order.created_at >= to_naive_utc(since))
+    if until is not None:
+        statement = statement.where(Order.created_at < to_naive_utc(until))
+    return statement
+
+@app.get("/orders", response_model=OrderPageOut, dependencies=[Depends(require_admin)], summary="Order history and admin search with keyset pagination")
+async def list_orders(
+    user_id: Optional[int] = None,
+    order_status: Optional[str] = Query(None, alias="status"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(50, gt=0, le=200),
+    session: AsyncSession = Depends(get_session),
+):
+    statement = filter_orders(select(Order), user_id, order_status, since, until)
+    if cursor:
+        cursor_created_at, cursor_id = decode_order_cursor(cursor)
+        statement = statement.where(or_(
+            Order.created_at < cursor_created_at,
+            (Order.created_at == cursor_created_at) & (Order.id < cursor_id),
+        ))
+    # Новые заказы первыми; limit + 1 — чтобы понять, есть ли следующая страница
+    orders = (await session.execute(
+        statement
+        .options(selectinload(Order.order_items))
+        .order_by(Order.created_at.desc(), Order.id.desc())
+        .limit(limit + 1)
+    )).scalars().all()
+
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_order_cursor(orders[-1].created_at, orders[-1].id)
+    return OrderPageOut(items=[OrderOut.from_orm_with_items(order) for order in orders], next_cursor=next_cursor)
+
+@app.get("/orders/export", dependencies=[Depends(require_admin)], summary="Stream orders as CSV or NDJSON")
+async def export_orders(
+    export_format: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    user_id: Optional[int] = None,
+    order_status: Optional[str] = Query(None, alias="status"),
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+):
+    statement = filter_orders(
+        select(*[getattr(Order, column) for column in ORDER_EXPORT_COLUMNS]),
+        user_id, order_status, since, until,
+    ).order_by(Order.created_at, Order.id)
+
+    def encode_row(row) -> str:
+        values = {column: row[index] for index, column in enumerate(ORDER_EXPORT_COLUMNS)}
+        values["created_at"] = values["created_at"].isoformat() if values["created_at"] else None
+        if export_format == "ndjson":
+            return json.dumps(values, ensure_ascii=False) + "\n"
+        buffer = io.StringIO()
+        csv.writer(buffer).writerow([values[column] for column in ORDER_EXPORT_COLUMNS])
+        return buffer.getvalue()
+
+    async def row_stream():
+        if export_format == "csv":
+            yield ",".join(ORDER_EXPORT_COLUMNS) + "\r\n"
+        # Своя сессия: зависимость get_session закрывается раньше, чем закончится стриминг.
+        # Серверный курсор + yield_per — весь результат в память не загружается.
+        async with async_session() as session:
+            result = await session.stream(statement.execution_options(yield_per=500))
+            async for partition in result.partitions():
+                yield "".join(encode_row(row) for row in partition)
+
+    media_type = "application/x-ndjson" if export_format == "ndjson" else "text/csv"
+    return StreamingResponse(
+        row_stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="orders.{export_format}"'},
+    )
 
 @app.get("/check_payment/{order_id}", summary="Check order payment status")
 async def check_payment_status(order_id: str, session: AsyncSession = Depends(get_session)):
@@ -703,6 +2951,10 @@ async def check_payment_status(order_id: str, session: AsyncSession = Depends(ge
     if order_db_obj.status == "paid":
         logger.info(f"Order {order_id} already paid.")
         return {"status": "paid", "message": "Order is already paid."}
+
+    if order_db_obj.status == "expired":
+        logger.info(f"Order {order_id} has expired.")
+        return {"status": "expired", "message": "Payment window for this order has expired."}
     
     if not order_db_obj.payment_address or order_db_obj.payment_amount is None:
         logger.warning(f"Order {order_id} has no payment address or amount. Cannot check payment.")
@@ -722,6 +2974,7 @@ async def check_payment_status(order_id: str, session: AsyncSession = Depends(ge
                 await session.commit()
                 await session.refresh(order_db_obj) # Обновляем объект для актуальных данных
                 logger.info(f"Order {order_id} is now PAID after manual check! Delivery details awaiting.")
+                await payment_event_bus.publish(order_id, "paid")
             return {"status": "paid", "message": "Payment confirmed."}
         else:
             logger.info(f"Order {order_id} not yet paid based on manual check.")
@@ -734,6 +2987,51 @@ async def check_payment_status(order_id: str, session: AsyncSession = Depends(ge
         logger.error(f"Unexpected error during manual payment check for order {order_id}: {e}", exc_info=True)
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="An unexpected error occurred during payment check.")
 
+def _sse_event(order_status: str) -> str:
+    return f"event: status\ndata: {json.dumps({'status': order_status})}\n\n"
+
+@app.get("/payment_events/{order_id}", summary="Server-Sent Events stream of order payment status")
+async def payment_events(order_id: str, request: Request, session: AsyncSession = Depends(get_session)):
+    # Подписываемся до чтения статуса из БД, чтобы не пропустить смену статуса между ними.
+    queue = payment_event_bus.subscribe(order_id)
+    order_status = (await session.execute(select(Order.status).where(Order.id == order_id))).scalar_one_or_none()
+    await session.close()
+    if order_status is None:
+        payment_event_bus.unsubscribe(order_id, queue)
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Order not found.")
+
+    async def event_stream():
+        try:
+            yield _sse_event(order_status)
+            if order_status != "unpaid":
+                return
+            while not await request.is_disconnected():
+                try:
+                    new_status = await asyncio.wait_for(queue.get(), timeout=config.PAYMENT_EVENTS_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    # Статус мог сменить другой воркер, а без Redis его событие сюда не дойдёт: сверяемся с БД
+                    async with async_session() as check_session:
+                        new_status = (await check_session.execute(select(Order.status).where(Order.id == order_id))).scalar_one_or_none()
+                    if new_status == "unpaid":
+                        yield ": keepalive\n\n"
+                        continue
+                    if new_status is None:
+                        return
+                yield _sse_event(new_status)
+                if new_status != "unpaid":
+                    return
+        finally:
+            payment_event_bus.unsubscribe(order_id, queue)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
 if __name__ == "__main__":
-    import uvicorn
-    uvicorn.run("simple_api:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        asyncio.run(run_migrations())
+    else:
+        import uvicorn
+        uvicorn.run("simple_api:app", host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
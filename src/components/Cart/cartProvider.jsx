@@ -58,6 +58,25 @@ export default function CartProvider({ children }) {
     fetchCart();
   }, [fetchCart]); // Зависимость только от fetchCart
 
+  // Все изменения корзины — одним запросом: сервер применяет операции в одной транзакции и сразу возвращает новую корзину
+  const applyCartOperations = async (operations) => {
+    const res = await fetch(`${API_URL}/cart/${USER_ID}/batch`, {
+      method: "POST",
+      headers: {
+        "Content-Type": "application/json",
+      },
+      body: JSON.stringify({ operations }),
+    });
+    if (!res.ok) {
+      const errorData = await res.json();
+      throw new Error(errorData.detail || "Failed to update cart.");
+    }
+    const data = await res.json();
+    const validCart = Array.isArray(data) ? data.filter(item => item.price > 0 && item.id > 0) : [];
+    setCart(validCart);
+    return validCart;
+  };
+
   const addToCart = async (productId, quantity = 1) => {
     if (quantity <= 0) {
       alert("Quantity must be positive.");
@@ -65,16 +84,7 @@ export default function CartProvider({ children }) {
     }
     setIsLoading(true);
     try {
-      // Используем константу USER_ID
-      const res = await fetch(
-        `${API_URL}/add_to_cart/?user_id=${USER_ID}&product_id=${productId}&quantity=${quantity}`,
-        { method: "POST" }
-      );
-      if (!res.ok) {
-        const errorData = await res.json();
-        throw new Error(errorData.detail || "Failed to add item to cart.");
-      }
-      await fetchCart();
+      await applyCartOperations([{ op: "increment", product_id: productId, quantity }]);
       alert("Item added to cart!");
     } catch (e) {
       alert("Error adding to cart: " + e.message);
@@ -85,7 +95,7 @@ export default function CartProvider({ children }) {
 
   const updateQuantity = async (productId, newQuantity) => {
     if (newQuantity < 1) { 
-      await removeFromCart(productId, cart.find(item => item.id === productId)?.quantity || 1); 
+      await removeFromCart(productId); 
       return;
     }
     setIsLoading(true);
@@ -94,26 +104,10 @@ export default function CartProvider({ children }) {
       if (!currentItem) {
         throw new Error("Product not found in cart.");
       }
-      
-      const quantityDiff = newQuantity - currentItem.quantity;
-      if (quantityDiff === 0) {
-        setIsLoading(false);
+      if (newQuantity === currentItem.quantity) {
         return;
       }
-
-      const endpoint = quantityDiff > 0 ? "/add_to_cart/" : "/del_from_cart/";
-      const method = quantityDiff > 0 ? "POST" : "DELETE";
-      const quantityToSend = Math.abs(quantityDiff);
-
-      const res = await fetch(
-        `${API_URL}${endpoint}?user_id=${USER_ID}&product_id=${productId}&quantity=${quantityToSend}`,
-        { method: method }
-      );
-      if (!res.ok) {
-        const errorData = await res.json();
-        throw new Error(errorData.detail || "Failed to update item quantity.");
-      }
-      await fetchCart();
+      await applyCartOperations([{ op: "set", product_id: productId, quantity: newQuantity }]);
     } catch (e) {
       alert("Error updating quantity: " + e.message);
     } finally {
@@ -124,17 +118,10 @@ export default function CartProvider({ children }) {
   const removeFromCart = async (productId, quantityToRemove) => {
     setIsLoading(true);
     try {
-      const quantity = quantityToRemove || (cart.find(item => item.id === productId)?.quantity || 1); 
-
-      const res = await fetch(
-        `${API_URL}/del_from_cart/?user_id=${USER_ID}&product_id=${productId}&quantity=${quantity}`,
-        { method: "DELETE" }
-      );
-      if (!res.ok) {
-        const errorData = await res.json();
-        throw new Error(errorData.detail || "Failed to remove item from cart.");
-      }
-      await fetchCart();
+      const operation = quantityToRemove
+        ? { op: "increment", product_id: productId, quantity: -quantityToRemove }
+        : { op: "remove", product_id: productId };
+      await applyCartOperations([operation]);
       alert("Item removed from cart!");
     } catch (e) {
       alert("Error removing from cart: " + e.message);
@@ -146,24 +133,11 @@ export default function CartProvider({ children }) {
   const clearCart = async () => {
     setIsLoading(true);
     try {
-        const res = await fetch(`${API_URL}/get_cart/${USER_ID}`);
-        if (!res.ok) {
-            const errorData = await res.json();
-            throw new Error(errorData.detail || "Failed to fetch cart before clearing.");
-        }
-        const currentCart = await res.json();
-        if (!Array.isArray(currentCart) || currentCart.length === 0) {
+        if (!Array.isArray(cart) || cart.length === 0) {
             setCart([]);
             return; 
         }
-
-        for (const item of currentCart) {
-            await fetch(
-                `${API_URL}/del_from_cart/?user_id=${USER_ID}&product_id=${item.id}&quantity=${item.quantity}`,
-                { method: "DELETE" }
-            );
-        }
-        setCart([]);
+        await applyCartOperations(cart.map(item => ({ op: "remove", product_id: item.id })));
         alert("Cart cleared!");
     } catch (e) {
         alert("Error clearing cart: " + e.message);
@@ -227,7 +201,7 @@ export default function CartProvider({ children }) {
       }
 
       const paymentData = await response.json();      
-      await clearCart();
+      setCart([]); // create_order уже очистил корзину на сервере — лишний запрос не нужен
       return paymentData;
     } catch (error) {
       console.error("Payment error:", error);
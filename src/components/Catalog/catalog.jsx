@@ -54,25 +54,31 @@ function Catalog() {
       .finally(() => setCategoriesLoading(false));
   }, [activeButton]);
 
-  // Загрузка товаров (однократно)
+  // Загрузка товаров: фильтр по полу и категории выполняет сервер, поиск по имени — на клиенте
   useEffect(() => {
-    fetch(`${api_url}/get_products/`)
+    const params = new URLSearchParams({
+      gender: activeButton === "left" ? "male" : "female",
+      fields: "id,name,price,image_url",
+    });
+    if (selectedCategory) {
+      params.set("category", selectedCategory);
+    }
+    let ignore = false; // игнорируем ответ, если фильтр успел смениться
+    fetch(`${api_url}/get_products/?${params.toString()}`)
       .then((response) => response.json())
-      .then((data) => setProducts(data))
+      .then((data) => {
+        if (!ignore) setProducts(data);
+      })
       .catch((error) => console.error("Error fetching products:", error))
       .finally(() => setProductsLoading(false));
-  }, []);
-
-  const filteredProducts = products.filter((product) => {
-    const genderMatch =
-      activeButton === "left" ? product.gender === "male" : product.gender === "female";
+    return () => {
+      ignore = true;
+    };
+  }, [activeButton, selectedCategory]);
 
-    const searchMatch = product.name.toLowerCase().includes(searchQuery.toLowerCase());
-
-    const categoryMatch = selectedCategory ? product.category === selectedCategory : true;
-
-    return genderMatch && searchMatch && categoryMatch;
-  });
+  const filteredProducts = products.filter((product) =>
+    product.name.toLowerCase().includes(searchQuery.toLowerCase())
+  );
 
   if (categoriesLoading || productsLoading) {
     return <div className={styles.loading}>Loading...</div>;
@@ -23,7 +23,7 @@ const Header = () => {
         }
     }, []);
 
-    const avatarUrl = userId ? `${API_BASE_URL}/get_avatar/${userId}` : null;
+    const avatarUrl = userId ? `${API_BASE_URL}/get_user_avatar/${userId}` : null;
 
     return (
         <header className="header">
@@ -75,6 +75,23 @@ export default function Payment() {
 
     useEffect(() => {
         let intervalId;
+        let eventSource;
+
+        // Общая обработка статуса для SSE и для запасного опроса. Возвращает true, если ждать больше нечего.
+        const applyStatus = (newStatus) => {
+            setPaymentStatus(newStatus);
+
+            if (newStatus === "paid") {
+                alert("Payment confirmed! Now fill in delivery details.");
+                navigate(`/order/${orderIdRef.current}`, { state: { orderStatus: 'paid' } }); 
+                return true;
+            }
+            if (newStatus === "expired") {
+                return true; // Окно оплаты истекло — больше не проверяем
+            }
+            // Если статус не paid, но и не pending (например, "unpaid"), продолжаем ждать
+            return false; 
+        };
 
         const checkPaymentStatus = async () => {
             if (!orderIdRef.current) {
@@ -91,16 +108,7 @@ export default function Payment() {
                 }
                 const data = await res.json();
                 console.log("Payment status check response:", data);
-
-                setPaymentStatus(data.status);
-                
-                if (data.status === "paid") {
-                    alert("Payment confirmed! Now fill in delivery details.");
-                    navigate(`/order/${orderIdRef.current}`, { state: { orderStatus: 'paid' } }); 
-                    return true;
-                }
-                // Если статус не paid, но и не pending (например, "unpaid"), продолжаем проверять
-                return false; 
+                return applyStatus(data.status);
             } catch (error) {
                 console.error("Error checking payment status:", error);
                 setPaymentStatus("failed"); 
@@ -110,24 +118,51 @@ export default function Payment() {
             }
         };
 
-        // Запускаем проверку статуса, если paymentDetails загружены и статус не "paid" и не "failed"
-        if (paymentDetails && paymentStatus !== "paid" && paymentStatus !== "failed") {
-            checkPaymentStatus(); // Проверяем немедленно при первом запуске или изменении зависимостей
+        // Запасной вариант, если браузер не поддерживает EventSource или поток оборвался
+        const startPolling = () => {
+            if (intervalId) {
+                return;
+            }
+            checkPaymentStatus();
             intervalId = setInterval(async () => {
                 const finished = await checkPaymentStatus();
                 if (finished) {
                     clearInterval(intervalId);
                 }
             }, CHECK_INTERVAL);
+        };
+
+        // Сервер сам сообщает о смене статуса через Server-Sent Events — без повторных запросов
+        if (paymentDetails && orderIdRef.current) {
+            if (typeof window.EventSource === "function") {
+                eventSource = new EventSource(`${API_URL}/payment_events/${orderIdRef.current}`);
+                eventSource.addEventListener("status", (event) => {
+                    const data = JSON.parse(event.data);
+                    console.log("Payment status event:", data);
+                    if (applyStatus(data.status)) {
+                        eventSource.close();
+                    }
+                });
+                eventSource.onerror = () => {
+                    console.warn("Payment events stream failed, falling back to polling.");
+                    eventSource.close();
+                    startPolling();
+                };
+            } else {
+                startPolling();
+            }
         }
 
-        // Очистка интервала при размонтировании компонента или изменении зависимостей
+        // Закрываем поток и интервал при размонтировании компонента или изменении зависимостей
         return () => {
+            if (eventSource) {
+                eventSource.close();
+            }
             if (intervalId) {
                 clearInterval(intervalId);
             }
         };
-    }, [paymentDetails, paymentStatus, navigate]); // Зависимости от paymentDetails и paymentStatus
+    }, [paymentDetails, navigate]); // Поток открывается один раз на заказ
 
     if (!paymentDetails) {
         return <div className="wrapper">Loading payment details...</div>;
@@ -165,6 +200,12 @@ export default function Payment() {
                     <p>Redirecting you to the delivery details page...</p>
                 </div>
             )}
+            {paymentStatus === "expired" && (
+                <div className="payment-failure">
+                    <h2 className="failure-title">Payment Window Expired ⌛</h2>
+                    <p>Order ID: <strong>{paymentDetails.orderId}</strong> was not paid in time. Please create a new order or contact support.</p>
+                </div>
+            )}
             {paymentStatus === "failed" && (
                 <div className="payment-failure">
                     <h2 className="failure-title">Payment Error ❌</h2>
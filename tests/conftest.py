@@ -0,0 +1,40 @@
+# Общие фикстуры: тестовая база на SQLite и, если задан TEST_POSTGRES_URL (postgresql+asyncpg://...), на PostgreSQL.
+# База PostgreSQL должна быть одноразовой — фикстура пересоздаёт в ней схему public.
+import os
+import sys
+from contextlib import asynccontextmanager
+
+import pytest
+from sqlalchemy import text
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import simple_api as api
+
+@pytest.fixture(params=["sqlite", "postgresql"])
+def db_url(request, tmp_path):
+    if request.param == "sqlite":
+        return f"sqlite+aiosqlite:///{tmp_path / 'smoke.db'}"
+    url = os.environ.get("TEST_POSTGRES_URL")
+    if not url:
+        pytest.skip("TEST_POSTGRES_URL is not set")
+    return url
+
+@pytest.fixture
+def use_db(db_url, monkeypatch):
+    @asynccontextmanager
+    async def connect():
+        # Модуль работает через глобальные engine/async_session — подменяем их на тестовую базу
+        engine = api.create_db_engine(db_url)
+        monkeypatch.setattr(api, "engine", engine)
+        monkeypatch.setattr(api, "async_session", api.async_sessionmaker(engine, expire_on_commit=False))
+        if engine.dialect.name == "postgresql":
+            async with engine.begin() as conn:
+                await conn.execute(text("DROP SCHEMA public CASCADE"))
+                await conn.execute(text("CREATE SCHEMA public"))
+        async with engine.begin() as conn:
+            await conn.run_sync(api.apply_migrations)
+        try:
+            yield engine
+        finally:
+            await engine.dispose()
+    return connect
@@ -0,0 +1,70 @@
+# Кэш аватаров: сбой транспорта Telegram отдаётся как 502, фоновая чистка файлов не теряет ошибок.
+import asyncio
+import os
+import time
+
+import httpx
+import pytest
+
+import simple_api as api
+
+class BrokenBody(httpx.AsyncByteStream):
+    async def __aiter__(self):
+        yield b"partial"
+        raise httpx.ReadError("connection reset while reading body")
+
+def make_avatar_cache(tmp_path, file_response) -> api.AvatarCache:
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/getUserProfilePhotos"):
+            return httpx.Response(200, json={"ok": True, "result": {"total_count": 1, "photos": [[{"file_id": "F"}]]}})
+        if request.url.path.endswith("/getFile"):
+            return httpx.Response(200, json={"ok": True, "result": {"file_path": "photos/file_1.jpg"}})
+        return file_response(request)
+
+    telegram_service = api.TelegramService("https://telegram.test/bot", httpx.AsyncClient(transport=httpx.MockTransport(handler)))
+    cache = api.SharedCache(api.LRUCache(100, 100_000), "", "test", 5, "worker")
+    return api.AvatarCache(telegram_service, cache, str(tmp_path / "avatars"), 60, 60)
+
+def raise_read_error(request: httpx.Request) -> httpx.Response:
+    raise httpx.ReadError("connection reset", request=request)
+
+def broken_body(request: httpx.Request) -> httpx.Response:
+    return httpx.Response(200, stream=BrokenBody())
+
+@pytest.mark.parametrize("file_response", [raise_read_error, broken_body])
+def test_transport_errors_become_bad_gateway(tmp_path, monkeypatch, file_response):
+    monkeypatch.setattr(api.config, "FILE_API", "https://telegram.test/file")
+    avatar_cache = make_avatar_cache(tmp_path, file_response)
+
+    async def scenario():
+        with pytest.raises(api.HTTPException) as error:
+            await avatar_cache.get(1)
+        await avatar_cache.telegram_service.http_client.aclose()
+        return error.value
+
+    assert asyncio.run(scenario()).status_code == 502
+    # Недокачанный временный файл не остаётся на диске
+    cache_dir = tmp_path / "avatars"
+    assert not cache_dir.exists() or not [name for name in os.listdir(cache_dir) if name.endswith(".tmp")]
+
+def test_prune_task_is_tracked_and_its_error_logged(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(api.config, "FILE_API", "https://telegram.test/file")
+    avatar_cache = make_avatar_cache(tmp_path, lambda request: httpx.Response(200, content=b"JPEG" * 10))
+    avatar_cache._last_prune = time.monotonic() - avatar_cache.ttl - 1
+
+    def failing_prune():
+        raise OSError("disk went away")
+    monkeypatch.setattr(avatar_cache, "_prune_files", failing_prune)
+
+    async def scenario():
+        entry = await avatar_cache.get(1)
+        assert entry["size"] == 40
+        prune_tasks = list(avatar_cache._prune_tasks)
+        assert len(prune_tasks) == 1
+        await asyncio.gather(*prune_tasks, return_exceptions=True)
+        await asyncio.sleep(0)  # done-callback выполняется на следующем шаге цикла
+        assert not avatar_cache._prune_tasks
+        await avatar_cache.telegram_service.http_client.aclose()
+
+    asyncio.run(scenario())
+    assert "Pruning stale avatar files failed: disk went away" in caplog.text
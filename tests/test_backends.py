@@ -0,0 +1,140 @@
+# Смоук-тесты SQL, который расходится между диалектами: миграции, upsert'ы и claim-запросы.
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from sqlalchemy import select, update
+
+import simple_api as api
+
+# Больше 2^31: такие id у Telegram уже есть, INTEGER в PostgreSQL на них переполняется
+BIG_USER_ID = 7_000_000_000
+
+async def add_product(name: str = "Shirt", price: int = 10) -> int:
+    async with api.async_session() as session:
+        product = api.Product(name=name, price=price, gender="unisex", category="tops", image_url="/img.png")
+        session.add(product)
+        await session.commit()
+        return product.id
+
+def test_migrations(use_db):
+    async def scenario():
+        async with use_db() as engine:
+            async with engine.begin() as conn:
+                assert await conn.run_sync(api.get_schema_version) == api.SCHEMA_VERSION
+                # Повторный прогон ничего не применяет
+                assert await conn.run_sync(api.apply_migrations) == api.SCHEMA_VERSION
+                await conn.run_sync(api.check_schema_version)
+    asyncio.run(scenario())
+
+def test_cart_upsert(use_db):
+    async def scenario():
+        async with use_db():
+            product_id = await add_product()
+            async with api.async_session() as session:
+                await api.upsert_cart_quantity(session, BIG_USER_ID, product_id, 2, increment=True)
+                await api.upsert_cart_quantity(session, BIG_USER_ID, product_id, 3, increment=True)
+                await session.commit()
+                rows = (await session.execute(
+                    select(api.CartItem.user_id, api.CartItem.quantity).where(api.CartItem.product_id == product_id)
+                )).all()
+            assert rows == [(BIG_USER_ID, 5)]
+
+            async with api.async_session() as session:
+                await api.upsert_cart_quantity(session, BIG_USER_ID, product_id, 1, increment=False)
+                await session.commit()
+                quantity = (await session.execute(select(api.CartItem.quantity))).scalar_one()
+            assert quantity == 1
+    asyncio.run(scenario())
+
+def test_checkout(use_db, monkeypatch):
+    async def get_quote():
+        return api.ExchangeRateQuote(rate=50_000.0, source="test", fetched_at=datetime.utcnow())
+    monkeypatch.setattr(api.exchange_rate_service, "get_quote", get_quote)
+
+    async def scenario():
+        async with use_db():
+            product_id = await add_product(price=25)
+            async with api.async_session() as session:
+                await api.upsert_cart_quantity(session, BIG_USER_ID, product_id, 2, increment=True)
+                session.add(api.PaymentAddress(
+                    address="pool-address-1",
+                    network=api.bitcoin_payment_service.network,
+                    wallet_name=api.config.ADDRESS_POOL_WALLET_NAME,
+                    status="available",
+                ))
+                await session.commit()
+
+            item = api.CartProductOut(id=product_id, name="Shirt", price=25, gender="unisex", category="tops", image_url="/img.png", quantity=2)
+            async with api.async_session() as session:
+                order = await api.create_order(api.OrderIn(user_id=BIG_USER_ID, items=[item], total=50), session)
+            assert order.total == 50
+            assert order.payment_address == "pool-address-1"
+
+            async with api.async_session() as session:
+                assert (await session.execute(select(api.CartItem.id))).first() is None
+                assert (await session.execute(select(api.Order.user_id))).scalar_one() == BIG_USER_ID
+                pool_row = (await session.execute(select(api.PaymentAddress.status, api.PaymentAddress.user_id))).one()
+            assert tuple(pool_row) == ("assigned", BIG_USER_ID)
+    asyncio.run(scenario())
+
+def test_lease_upsert(use_db):
+    async def scenario():
+        async with use_db():
+            first = api.LeaderLease("smoke", "worker-a", 30)
+            second = api.LeaderLease("smoke", "worker-b", 30)
+            assert await first.acquire()
+            assert not await second.acquire()
+            # Продление своей аренды
+            assert await first.acquire()
+
+            async with api.async_session() as session:
+                await session.execute(
+                    update(api.JobLease).where(api.JobLease.name == "smoke").values(expires_at=datetime.utcnow() - timedelta(seconds=1))
+                )
+                await session.commit()
+            assert await second.acquire()
+            assert not await first.acquire()
+            await second.release()
+            assert await first.acquire()
+    asyncio.run(scenario())
+
+def test_order_scan_claim(use_db, monkeypatch):
+    paid_addresses = {"paid-address"}
+
+    async def check_address_transactions(payment_address, required_amount_btc, tolerance_percent):
+        return payment_address in paid_addresses
+    payment_service = SimpleNamespace(check_address_transactions=check_address_transactions)
+    scanner = api.PaymentScanner(payment_service, api.PaymentSchedule(60, 600, 24), 2, 10, 120)
+
+    async def scenario():
+        async with use_db():
+            now = datetime.utcnow()
+            async with api.async_session() as session:
+                session.add_all([
+                    api.Order(id="paid", user_id=BIG_USER_ID, total=1, payment_address="paid-address", payment_amount=0.001, created_at=now, next_check_at=now),
+                    api.Order(id="waiting", user_id=BIG_USER_ID, total=1, payment_address="empty-address", payment_amount=0.001, created_at=now, next_check_at=now),
+                    api.Order(id="expired", user_id=BIG_USER_ID, total=1, payment_address="old-address", payment_amount=0.001, created_at=now - timedelta(days=2), next_check_at=now),
+                    api.Order(id="later", user_id=BIG_USER_ID, total=1, payment_address="later-address", payment_amount=0.001, created_at=now, next_check_at=now + timedelta(hours=1)),
+                ])
+                await session.commit()
+
+            await scanner.scan_once()
+            async with api.async_session() as session:
+                orders = {
+                    order.id: order
+                    for order in (await session.execute(select(api.Order))).scalars()
+                }
+            assert orders["paid"].status == "paid"
+            assert orders["expired"].status == "expired"
+            assert orders["waiting"].status == "unpaid"
+            assert orders["waiting"].check_attempts == 1
+            assert orders["waiting"].next_check_at > now
+            assert orders["later"].check_attempts == 0
+
+            # Перепланированный заказ ещё не подошёл: повторный цикл ничего не забирает
+            await scanner.scan_once()
+            async with api.async_session() as session:
+                attempts = (await session.execute(select(api.Order.check_attempts).where(api.Order.id == "waiting"))).scalar_one()
+            assert attempts == 1
+    asyncio.run(scenario())
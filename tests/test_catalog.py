@@ -0,0 +1,37 @@
+# ETag каталога: одинаковый у всех воркеров для одинаковых байт и свой у каждого варианта сжатия.
+import simple_api as api
+
+def make_request(**headers) -> api.Request:
+    return api.Request({
+        "type": "http",
+        "method": "GET",
+        "path": "/",
+        "headers": [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()],
+    })
+
+PAYLOAD = [{"id": product_id, "name": f"Product {product_id}"} for product_id in range(100)]
+
+def test_etag_does_not_depend_on_worker_history():
+    fresh = api.CatalogCache()
+    busy = api.CatalogCache()
+    # Другой воркер успел несколько раз перестроить снимок
+    for _ in range(3):
+        busy._rebuild_index()
+    assert fresh.encoded("catalog", PAYLOAD)["etag"] == busy.encoded("catalog", PAYLOAD)["etag"]
+
+def test_each_encoding_has_its_own_etag():
+    entry = api.CatalogCache().encoded("catalog", PAYLOAD)
+    etags = {}
+    for accept_encoding in ("", "gzip", "br"):
+        if accept_encoding and accept_encoding not in entry:
+            continue
+        response = api.catalog_response(make_request(accept_encoding=accept_encoding), entry)
+        assert response.status_code == 200
+        assert response.headers.get("content-encoding", "") == accept_encoding
+        etags[accept_encoding] = response.headers["etag"]
+    assert len(set(etags.values())) == len(etags) > 1
+
+    # 304 только для ETag того варианта, который был бы отдан
+    gzip_etag = etags["gzip"]
+    assert api.catalog_response(make_request(accept_encoding="gzip", if_none_match=gzip_etag), entry).status_code == 304
+    assert api.catalog_response(make_request(if_none_match=gzip_etag), entry).status_code == 200
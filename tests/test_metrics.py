@@ -0,0 +1,55 @@
+# HTTP-метрики: ASGI-middleware считает запросы по шаблону маршрута и статусу ответа.
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+import simple_api as api
+
+def requests_total(route: str, status_code: int) -> float:
+    return REGISTRY.get_sample_value("http_requests_total", {"method": "GET", "route": route, "status": str(status_code)}) or 0.0
+
+def make_app() -> FastAPI:
+    app = FastAPI()
+    app.add_middleware(api.RequestMetricsMiddleware)
+
+    @app.get("/metrics-test/items/{item_id}")
+    async def get_item(item_id: int):
+        return {"id": item_id}
+
+    @app.get("/metrics-test/boom")
+    async def boom():
+        raise RuntimeError("handler failed")
+
+    @app.get("/metrics-test/stream")
+    async def stream():
+        async def chunks():
+            yield b"a"
+            yield b"b"
+        return StreamingResponse(chunks())
+
+    return app
+
+def test_requests_are_counted_by_route_template_and_status():
+    cases = [
+        ("/metrics-test/items/1", "/metrics-test/items/{item_id}", 200),
+        ("/metrics-test/items/2", "/metrics-test/items/{item_id}", 200),
+        ("/metrics-test/items/x", "/metrics-test/items/{item_id}", 422),
+        ("/metrics-test/stream", "/metrics-test/stream", 200),
+        ("/metrics-test/boom", "/metrics-test/boom", 500),
+        ("/metrics-test/missing", "unmatched", 404),
+    ]
+    before = {(route, status_code): requests_total(route, status_code) for _, route, status_code in cases}
+    in_progress_before = REGISTRY.get_sample_value("http_requests_in_progress")
+
+    with TestClient(make_app(), raise_server_exceptions=False) as client:
+        for path, _, status_code in cases:
+            response = client.get(path)
+            assert response.status_code == status_code
+            if path.endswith("stream"):
+                assert response.content == b"ab"
+
+    assert requests_total("/metrics-test/items/{item_id}", 200) - before[("/metrics-test/items/{item_id}", 200)] == 2
+    for _, route, status_code in cases[2:]:
+        assert requests_total(route, status_code) - before[(route, status_code)] == 1
+    assert REGISTRY.get_sample_value("http_requests_in_progress") == in_progress_before
@@ -0,0 +1,71 @@
+# Отправка пачки уведомлений: сбой одного сообщения не должен откатывать результаты остальных.
+import asyncio
+import json
+from datetime import datetime, timedelta
+
+import httpx
+from sqlalchemy import select, update
+
+import simple_api as api
+
+DELIVERED_CHAT = 1
+READ_ERROR_CHAT = 2
+BROKEN_CHAT = 3
+
+def telegram_handler(request: httpx.Request) -> httpx.Response:
+    chat_id = json.loads(request.content)["chat_id"]
+    if chat_id == READ_ERROR_CHAT:
+        raise httpx.ReadError("connection reset while reading response", request=request)
+    if chat_id == BROKEN_CHAT:
+        raise RuntimeError("unexpected failure")
+    return httpx.Response(200, json={"ok": True})
+
+def make_outbox(max_attempts: int) -> api.NotificationOutbox:
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(telegram_handler))
+    telegram_service = api.TelegramService("https://telegram.test/bot", http_client)
+    return api.NotificationOutbox(telegram_service, 3, 10, 1, 10, max_attempts, 1, 60)
+
+async def load_messages() -> dict:
+    async with api.async_session() as session:
+        return {
+            message.chat_id: message
+            for message in (await session.execute(select(api.OutboxMessage))).scalars()
+        }
+
+def test_mixed_batch_keeps_each_result(use_db):
+    outbox = make_outbox(max_attempts=2)
+
+    async def scenario():
+        async with use_db():
+            async with api.async_session() as session:
+                for chat_id in (DELIVERED_CHAT, READ_ERROR_CHAT, BROKEN_CHAT):
+                    outbox.enqueue(session, chat_id, f"message for {chat_id}")
+                await session.commit()
+
+            assert await outbox.send_due() == 3
+            messages = await load_messages()
+            assert messages[DELIVERED_CHAT].status == "sent"
+            assert messages[DELIVERED_CHAT].attempts == 1
+            for chat_id in (READ_ERROR_CHAT, BROKEN_CHAT):
+                assert messages[chat_id].status == "pending"
+                assert messages[chat_id].attempts == 1
+                assert messages[chat_id].next_attempt_at > datetime.utcnow()
+            assert "ReadError" in messages[READ_ERROR_CHAT].last_error
+            assert "unexpected error" in messages[BROKEN_CHAT].last_error
+
+            # Следующая попытка исчерпывает лимит, доставленное сообщение повторно не отправляется
+            async with api.async_session() as session:
+                await session.execute(
+                    update(api.OutboxMessage)
+                    .where(api.OutboxMessage.status == "pending")
+                    .values(next_attempt_at=datetime.utcnow() - timedelta(seconds=1))
+                )
+                await session.commit()
+            assert await outbox.send_due() == 2
+            messages = await load_messages()
+            assert messages[DELIVERED_CHAT].attempts == 1
+            assert messages[READ_ERROR_CHAT].status == "failed"
+            assert messages[BROKEN_CHAT].status == "failed"
+            assert outbox.stats() == {"sent": 1, "retried": 2, "failed": 2, "rate_limited": 0}
+            await outbox.telegram_service.http_client.aclose()
+    asyncio.run(scenario())
@@ -0,0 +1,25 @@
+# Фильтры истории заказов: границы since/until со смещением сравниваются с наивными UTC-колонками.
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import simple_api as api
+
+def test_list_orders_converts_aware_bounds_to_utc(use_db):
+    async def scenario():
+        async with use_db():
+            async with api.async_session() as session:
+                session.add_all([
+                    api.Order(id=f"order-{hour}", user_id=1, total=1, created_at=datetime(2026, 1, 2, hour))
+                    for hour in (0, 1, 2)
+                ])
+                await session.commit()
+
+            # 2026-01-01T23:00-02:00 == 2026-01-02T01:00 UTC
+            since = datetime(2026, 1, 1, 23, tzinfo=timezone(timedelta(hours=-2)))
+            until = datetime(2026, 1, 2, 4, tzinfo=timezone(timedelta(hours=2)))
+            async with api.async_session() as session:
+                page = await api.list_orders(
+                    user_id=None, order_status=None, since=since, until=until, cursor=None, limit=50, session=session,
+                )
+            assert [order.id for order in page.items] == ["order-1"]
+    asyncio.run(scenario())
@@ -0,0 +1,47 @@
+# Архивация и повторное добавление товара через /add_product/.
+import asyncio
+
+import pytest
+from sqlalchemy import select
+
+import simple_api as api
+
+def shirt(**overrides) -> api.ProductIn:
+    return api.ProductIn(**{"name": "Shirt", "price": 10, "gender": "unisex", "category": "tops", "image_url": "/img.png", **overrides})
+
+def test_add_product_restores_archived(use_db):
+    async def scenario():
+        async with use_db():
+            async with api.async_session() as session:
+                created = await api.add_product(shirt(), session)
+            async with api.async_session() as session:
+                await api.delete_category("tops", archive=True, session=session)
+
+            # Тот же товар снова появляется в каталоге под прежним id
+            async with api.async_session() as session:
+                restored = await api.add_product(shirt(price=12), session)
+            assert restored.id == created.id
+            assert restored.price == 12
+            assert restored.archived_at is None
+
+            # Архивный товар можно вернуть и в другую категорию: строка одна, name уникален
+            async with api.async_session() as session:
+                await api.delete_product(created.id, archive=True, session=session)
+            async with api.async_session() as session:
+                moved = await api.add_product(shirt(category="shirts", gender="male"), session)
+            assert (moved.id, moved.category, moved.gender) == (created.id, "shirts", "male")
+            async with api.async_session() as session:
+                assert (await session.execute(select(api.Product.id))).scalars().all() == [created.id]
+    asyncio.run(scenario())
+
+def test_add_product_rejects_live_duplicates(use_db):
+    async def scenario():
+        async with use_db():
+            async with api.async_session() as session:
+                await api.add_product(shirt(), session)
+            for duplicate in (shirt(), shirt(category="shirts")):
+                async with api.async_session() as session:
+                    with pytest.raises(api.HTTPException) as error:
+                        await api.add_product(duplicate, session)
+                assert error.value.status_code == 400
+    asyncio.run(scenario())
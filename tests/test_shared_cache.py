@@ -0,0 +1,133 @@
+# Общий кэш: LRU-уровень и Redis-бэкенд на локальном фейковом сервере (fakeredis), два воркера в одном процессе.
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+import simple_api as api
+
+def test_lru_evicts_by_entry_count():
+    cache = api.LRUCache(max_entries=3, max_bytes=1000)
+    for index in range(3):
+        cache.set(f"k{index}", b"x")
+    cache.get("k0")  # k0 становится самым свежим, первым вытесняется k1
+    cache.set("k3", b"x")
+    assert cache.get("k1") is None
+    assert [cache.get(key) for key in ("k0", "k2", "k3")] == [b"x", b"x", b"x"]
+    assert cache.stats()["evictions"] == 1
+
+def test_lru_evicts_by_bytes():
+    cache = api.LRUCache(max_entries=100, max_bytes=100)
+    for index in range(5):
+        cache.set(f"k{index}", b"x" * 20)
+    cache.set("big", b"y" * 50)
+    assert cache.stats()["bytes"] <= 100
+    assert [cache.get(f"k{index}") for index in range(3)] == [None, None, None]
+    assert cache.get("big") == b"y" * 50
+    # Значение больше лимита целиком не кэшируется и не вытесняет остальное
+    cache.set("huge", b"z" * 101)
+    assert cache.get("huge") is None
+    assert cache.get("big") == b"y" * 50
+
+def test_lru_expires_by_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(api.time, "monotonic", lambda: now[0])
+    cache = api.LRUCache(max_entries=10, max_bytes=1000)
+    cache.set("short", b"1", ttl=5)
+    cache.set("forever", b"2")
+    now[0] += 4.9
+    assert cache.get("short") == b"1"
+    now[0] += 0.2
+    assert cache.get("short") is None
+    assert cache.get("forever") == b"2"
+    assert cache.stats()["bytes"] == 1
+
+@pytest.fixture
+def redis_url():
+    fakeredis = pytest.importorskip("fakeredis")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    server = fakeredis.TcpFakeServer(("127.0.0.1", port), server_type="redis")
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"redis://127.0.0.1:{port}/0"
+    server.shutdown()
+    server.server_close()
+
+def make_worker(redis_url: str, worker_id: str) -> api.SharedCache:
+    return api.SharedCache(api.LRUCache(100, 100_000), redis_url, "test", 5, worker_id)
+
+async def wait_for(condition, timeout: float = 5.0):
+    deadline = time.monotonic() + timeout
+    while not await condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        await asyncio.sleep(0.02)
+
+async def start_listeners(workers):
+    tasks = [asyncio.create_task(worker.listen()) for worker in workers]
+    channel = workers[0].channel
+
+    async def all_subscribed():
+        return dict(await workers[0].redis.pubsub_numsub(channel)).get(channel.encode(), 0) >= len(workers)
+    await wait_for(all_subscribed)
+    return tasks
+
+async def stop(tasks, workers):
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for worker in workers:
+        await worker.close()
+
+def test_value_written_by_one_worker_is_read_by_another(redis_url):
+    async def scenario():
+        first, second = make_worker(redis_url, "first"), make_worker(redis_url, "second")
+        await first.set_json("rate", {"eur": 50_000}, 60)
+        assert await second.get_json("rate") == {"eur": 50_000}
+        # Прочитанное из Redis оседает в локальном LRU второго воркера
+        assert second.local.get("rate") is not None
+        assert first.errors == second.errors == 0
+        await stop([], [first, second])
+    asyncio.run(scenario())
+
+def test_invalidate_reaches_other_worker(redis_url):
+    async def scenario():
+        first, second = make_worker(redis_url, "first"), make_worker(redis_url, "second")
+        notified = {"first": 0, "second": 0}
+        first.on_invalidate("catalog", lambda: notified.__setitem__("first", notified["first"] + 1))
+        second.on_invalidate("catalog", lambda: notified.__setitem__("second", notified["second"] + 1))
+        tasks = await start_listeners([first, second])
+
+        await first.set_json("catalog:all", [1, 2, 3], 60)
+        assert await second.get_json("catalog:all") == [1, 2, 3]
+        await first.invalidate("catalog:all")
+
+        async def second_invalidated():
+            return second.invalidations_received == 1
+        await wait_for(second_invalidated)
+        assert second.local.get("catalog:all") is None
+        assert await second.get_json("catalog:all") is None
+        # Инициатор своё состояние обновил сам: свой callback не вызывается
+        assert notified == {"first": 0, "second": 1}
+        await stop(tasks, [first, second])
+    asyncio.run(scenario())
+
+def test_events_are_delivered_to_other_workers_only(redis_url):
+    async def scenario():
+        first, second = make_worker(redis_url, "first"), make_worker(redis_url, "second")
+        received = {"first": [], "second": []}
+        first.on_event("payment_status", received["first"].append)
+        second.on_event("payment_status", received["second"].append)
+        tasks = await start_listeners([first, second])
+
+        await first.publish_event("payment_status", {"order_id": "o1", "status": "paid"})
+
+        async def delivered():
+            return bool(received["second"])
+        await wait_for(delivered)
+        assert received == {"first": [], "second": [{"order_id": "o1", "status": "paid"}]}
+        await stop(tasks, [first, second])
+    asyncio.run(scenario())